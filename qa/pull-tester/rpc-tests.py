@@ -19,6 +19,9 @@ than:
       with '-extended' and '-extended-only' too, to print subsets.
     - `-win`: signal that this is running in a Windows environment, and we
       should run the tests.
+    - `-jobs=N`: run up to N test scripts concurrently. Each job gets its
+      own block of p2p/rpc ports and its own tmpdir, and its output is
+      written to a separate log file. Longest tests are started first.
     - `--coverage`: this generates a basic coverage report for the RPC
       interface.
 
@@ -40,6 +43,7 @@ import re
 sys.path.append("qa/pull-tester/")
 from tests_config import *
 from test_classes import RpcTest, Disabled, Skip
+from test_timings import TestTimingDB
 
 BOLD = ("","")
 if os.name == 'posix':
@@ -61,6 +65,17 @@ if 'ENABLE_ZMQ' not in vars():
 
 ENABLE_COVERAGE=0
 
+# Parallel test execution (-jobs=N). Every test script reserves its own
+# block of p2p/rpc ports through the lock-file based allocator in
+# test_framework/util.py, so concurrently running tests never collide.
+# There are 50 such blocks, which bounds the number of jobs.
+NUM_JOBS = 1
+MAX_JOBS = 50
+
+# Durations and results of earlier runs, used to start the longest tests
+# first, predict the total run time and report slow tests
+TIMINGS_FILE = os.path.join(BUILDDIR, 'qa', 'pull-tester', 'rpc_test_timings.json')
+
 #Create a set to store arguments and create the passOn string
 opts = set()
 double_opts = set()  # BU: added for checking validity of -- opts
@@ -111,6 +126,14 @@ if (os.name == 'posix'):
 for arg in sys.argv[1:]:
     if arg == '--coverage':
         ENABLE_COVERAGE = 1
+    elif arg.startswith('-jobs=') or arg.startswith('--jobs='):
+        try:
+            NUM_JOBS = int(arg.split('=', 1)[1])
+        except ValueError:
+            NUM_JOBS = 0
+        if not 1 <= NUM_JOBS <= MAX_JOBS:
+            print("Invalid value for %s (must be between 1 and %d)" % (arg, MAX_JOBS))
+            sys.exit(1)
     elif (p.match(arg) or arg in ('-h', '-help')):
         if arg not in private_double_opts:
             if arg == '--help' or arg == '-help' or arg == '-h':
@@ -254,10 +277,64 @@ def show_wrapper_options():
           "                        run ONLY the extended tests")
     print("  -list / --list        only list test names")
     print("  -win / --win          signal running on Windows and run those tests")
+    print("  -jobs=N / --jobs=N    run up to N tests in parallel (max %d)" % MAX_JOBS)
     print("  -f / -force-enable / --force-enable\n" + \
           "                        attempt to run disabled/skipped tests")
     print("  -h / -help / --help   print this help")
 
+def run_tests_parallel(tests_to_run, rpcTestDir, flags, num_jobs, timing_db,
+                       execution_time, test_passed, test_failure_info):
+    """
+    Run the given tests with up to num_jobs of them executing at once.
+    The output of each test goes into its own log file, which is echoed
+    to the console if the test fails.
+    """
+    pending = []
+    for t in tests_to_run:
+        if str(t) not in [str(x) for x in pending]:
+            pending.append(t)
+    # start the longest running tests first, unknown ones go last
+    pending = timing_db.sort_longest_first(pending)
+
+    log_dir = tempfile.mkdtemp(prefix="rpctestlogs")
+    print("Running %d testscripts in %d parallel jobs, logs in %s\n" % (len(pending), num_jobs, log_dir))
+
+    free_slots = list(range(num_jobs))
+    running = []
+    while pending or running:
+        while pending and free_slots:
+            t = pending.pop(0)
+            slot = free_slots.pop(0)
+            fullscriptcmd = str(t)
+            tmpdir = tempfile.mkdtemp(prefix="test")
+            log_name = os.path.join(log_dir, re.sub(r"[^\w.-]", "_", fullscriptcmd) + ".log")
+            log_file = open(log_name, 'w')
+            print("Starting testscript %s%s%s (job %d) ..." % (bold[1], t, bold[0], slot))
+            proc = subprocess.Popen(rpcTestDir + repr(t) + flags + " --tmpdir %s" % tmpdir,
+                                    shell=True,
+                                    stdout=log_file, stderr=subprocess.STDOUT)
+            running.append((t, slot, proc, log_file, log_name, time.time()))
+
+        time.sleep(0.1)
+        for job in running[:]:
+            (t, slot, proc, log_file, log_name, time0) = job
+            if proc.poll() is None:
+                continue
+            running.remove(job)
+            free_slots.append(slot)
+            log_file.close()
+            fullscriptcmd = str(t)
+            execution_time[fullscriptcmd] = int(time.time() - time0)
+            test_passed[fullscriptcmd] = (proc.returncode == 0)
+            timing_db.record(fullscriptcmd, execution_time[fullscriptcmd], test_passed[fullscriptcmd])
+            if test_passed[fullscriptcmd]:
+                print("%-50s  PASS    Duration: %s s" % (fullscriptcmd, execution_time[fullscriptcmd]))
+            else:
+                test_failure_info[fullscriptcmd] = proc.returncode
+                print("%-50s  FAILED  Duration: %s s (exit code %d), log follows:" % (fullscriptcmd, execution_time[fullscriptcmd], proc.returncode))
+                with open(log_name, 'r') as f:
+                    print(f.read())
+
 def runtests():
     global passOn
     coverage = None
@@ -353,51 +430,63 @@ def runtests():
                     trimmed_tests_to_run.append(t)
             tests_to_run = trimmed_tests_to_run
 
+        timing_db = TestTimingDB(TIMINGS_FILE)
+        timing_db.start_run()
+        if not showHelp:
+            num_unknown = len([t for t in tests_to_run if timing_db.get_time(t) is None])
+            print("Predicted wall time: %d s (%d test(s) without timing data)\n"
+                  % (timing_db.predict_wall_time(tests_to_run, NUM_JOBS), num_unknown))
+
         # now run the tests
         p = re.compile(" -h| --help| -help")
-        for t in tests_to_run:
-            scriptname=re.sub(".py$", "", str(t).split(' ')[0])
-            fullscriptcmd=str(t)
-
-            # print the wrapper-specific help options
-            if showHelp:
-                show_wrapper_options()
-
-            if bad_opts_found:
-                if not ' --help' in passOn:
-                    passOn += ' --help'
-
-            if len(double_opts):
-                for additional_opt in fullscriptcmd.split(' ')[1:]:
-                    if additional_opt not in double_opts:
-                        continue
-
-            if fullscriptcmd not in execution_time.keys():
-                if t in testScripts:
-                    print("Running testscript %s%s%s ..." % (bold[1], t, bold[0]))
-                else:
-                    print("Running 2nd level testscript "
-                          + "%s%s%s ..." % (bold[1], t, bold[0]))
-
-                time0 = time.time()
-                test_passed[fullscriptcmd] = False
-                try:
-                    subprocess.check_call(
-                        rpcTestDir + repr(t) + flags, shell=True)
-                    test_passed[fullscriptcmd] = True
-                except subprocess.CalledProcessError as e:
-                    print( e )
-                    test_failure_info[fullscriptcmd] = e
-
-                # exit if help was called
+        if NUM_JOBS > 1 and not showHelp and not bad_opts_found:
+            run_tests_parallel(tests_to_run, rpcTestDir, flags, NUM_JOBS, timing_db,
+                               execution_time, test_passed, test_failure_info)
+        else:
+            for t in tests_to_run:
+                scriptname=re.sub(".py$", "", str(t).split(' ')[0])
+                fullscriptcmd=str(t)
+
+                # print the wrapper-specific help options
                 if showHelp:
-                    sys.exit(0)
-                else:
-                    execution_time[fullscriptcmd] = int(time.time() - time0)
-                    print("Duration: %s s\n" % execution_time[fullscriptcmd])
+                    show_wrapper_options()
+
+                if bad_opts_found:
+                    if not ' --help' in passOn:
+                        passOn += ' --help'
+
+                if len(double_opts):
+                    for additional_opt in fullscriptcmd.split(' ')[1:]:
+                        if additional_opt not in double_opts:
+                            continue
+
+                if fullscriptcmd not in execution_time.keys():
+                    if t in testScripts:
+                        print("Running testscript %s%s%s ..." % (bold[1], t, bold[0]))
+                    else:
+                        print("Running 2nd level testscript "
+                              + "%s%s%s ..." % (bold[1], t, bold[0]))
+
+                    time0 = time.time()
+                    test_passed[fullscriptcmd] = False
+                    try:
+                        subprocess.check_call(
+                            rpcTestDir + repr(t) + flags, shell=True)
+                        test_passed[fullscriptcmd] = True
+                    except subprocess.CalledProcessError as e:
+                        print( e )
+                        test_failure_info[fullscriptcmd] = e
+
+                    # exit if help was called
+                    if showHelp:
+                        sys.exit(0)
+                    else:
+                        execution_time[fullscriptcmd] = int(time.time() - time0)
+                        timing_db.record(fullscriptcmd, execution_time[fullscriptcmd], test_passed[fullscriptcmd])
+                        print("Duration: %s s\n" % execution_time[fullscriptcmd])
 
-            else:
-                print("Skipping extended test name %s - already executed in regular\n" % scriptname)
+                else:
+                    print("Skipping extended test name %s - already executed in regular\n" % scriptname)
 
         if coverage:
             coverage.report_rpc_coverage()
@@ -406,6 +495,11 @@ def runtests():
             coverage.cleanup()
 
         if not showHelp:
+            try:
+                timing_db.save()
+            except IOError as e:
+                print("Could not save test timings to %s: %s" % (TIMINGS_FILE, e))
+
             # show some overall results and aggregates
             print()
             print("%-50s  Status    Time (s)" % "Test")
@@ -425,6 +519,13 @@ def runtests():
                                                                        len(test_passed)))
             print("%d test(s) disabled / %d test(s) skipped due to platform" % (len(disabled), len(skipped)))
 
+            slowest = timing_db.slowest_report(execution_time.keys(), 10)
+            if slowest:
+                print()
+                print("Slowest tests (change from previous run):")
+                for line in slowest:
+                    print(line)
+
         # signal that tests have failed using exit code
         if list(test_passed.values()).count(False):
             sys.exit(1)
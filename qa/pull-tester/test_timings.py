@@ -0,0 +1,140 @@
+# Copyright (c) 2017 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+TestTimingDB: a small on-disk database of test durations and results
+
+Entries are keyed by the full test command (test name plus arguments, as
+produced by str(RpcTest)), so 'txn_clone.py' and 'txn_clone.py --mineblock'
+are tracked separately.
+
+>>> db = TestTimingDB(None)
+>>> db.record('a.py', 10, True)
+>>> db.record('b.py --quick', 3, False)
+>>> db.record('c.py', 7, True)
+>>> db.get_time('a.py')
+10
+>>> db.get_time('unknown.py') is None
+True
+>>> db.sort_longest_first(['b.py --quick', 'new.py', 'a.py', 'c.py'])
+['a.py', 'c.py', 'b.py --quick', 'new.py']
+>>> db.predict_wall_time(['a.py', 'b.py --quick', 'c.py'], 1)
+20
+>>> db.predict_wall_time(['a.py', 'b.py --quick', 'c.py'], 2)
+10
+>>> db.start_run()
+>>> db.record('a.py', 12, True)
+>>> db.get_time('a.py'), db.get_previous_time('a.py')
+(12, 10)
+>>> db.get_history('a.py')
+[True, True]
+>>> for line in db.slowest_report(['a.py', 'c.py'], 2): print(line)
+a.py                                                     12 s     (+2 s)
+c.py                                                      7 s      (new)
+"""
+
+import json
+import time
+
+# number of past results kept per test
+HISTORY_LENGTH = 20
+
+
+class TestTimingDB(object):
+    ''' Persistent record of test durations and pass/fail history '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.updated = set()
+        if filename:
+            self.load()
+
+    def load(self):
+        ''' load the database, starting empty if it is missing or corrupt '''
+        try:
+            with open(self.filename, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = {}
+        if not isinstance(entries, dict):
+            entries = {}
+        self.entries = entries
+
+    def save(self):
+        ''' write the database back to disk '''
+        with open(self.filename, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+    def start_run(self):
+        ''' mark the beginning of a new run, for computing deltas '''
+        self.updated = set()
+
+    def record(self, test, duration, passed):
+        ''' store the outcome of one execution of 'test' '''
+        test = str(test)
+        entry = self.entries.setdefault(test, {})
+        if test not in self.updated:
+            entry['previous'] = entry.get('time')
+        entry['time'] = duration
+        entry['date'] = int(time.time())
+        entry['history'] = (entry.get('history', []) + [bool(passed)])[-HISTORY_LENGTH:]
+        self.updated.add(test)
+
+    def get_time(self, test):
+        ''' last recorded duration of 'test' in seconds, or None '''
+        return self.entries.get(str(test), {}).get('time')
+
+    def get_previous_time(self, test):
+        ''' duration recorded for 'test' by the run before the last one, or None '''
+        return self.entries.get(str(test), {}).get('previous')
+
+    def get_history(self, test):
+        ''' list of past results (True = pass), oldest first '''
+        return self.entries.get(str(test), {}).get('history', [])
+
+    def default_time(self):
+        ''' estimate for tests that have never been run: the mean of known tests '''
+        known = [e['time'] for e in self.entries.values() if e.get('time') is not None]
+        if not known:
+            return 0
+        return sum(known) // len(known)
+
+    def sort_longest_first(self, tests):
+        ''' order tests longest first; tests without timings go last, in their original order '''
+        return sorted(tests, key=lambda t: -1 if self.get_time(t) is None else self.get_time(t),
+                      reverse=True)
+
+    def predict_wall_time(self, tests, num_jobs):
+        '''
+        Predict the total wall time of running 'tests' on num_jobs parallel
+        jobs, assuming they are started longest first and each test goes to
+        whichever job becomes free first.
+        '''
+        default = self.default_time()
+        job_end = [0] * max(1, num_jobs)
+        for t in self.sort_longest_first(tests):
+            duration = self.get_time(t)
+            if duration is None:
+                duration = default
+            first_free = job_end.index(min(job_end))
+            job_end[first_free] += duration
+        return max(job_end)
+
+    def slowest_report(self, tests, count=10):
+        ''' lines describing the 'count' slowest of 'tests', with deltas from the previous run '''
+        lines = []
+        timed = [t for t in tests if self.get_time(t) is not None]
+        for t in self.sort_longest_first(timed)[:count]:
+            duration = self.get_time(t)
+            previous = self.get_previous_time(t)
+            if previous is None:
+                delta = "(new)"
+            else:
+                delta = "(%+d s)" % (duration - previous)
+            lines.append("%-50s  %7d s  %9s" % (t, duration, delta))
+        return lines
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -106,7 +106,7 @@ class BIP68_112_113Test(ComparisonTestFramework):
                                  binary=[self.options.testbinary])
 
     def run_test(self):
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, pipeline=16)
         test.add_all_connections(self.nodes)
         NetworkThread().start() # Start up network handling in another thread
         test.run()
@@ -47,11 +47,7 @@ class BUProtocolHandler(NodeConnCB):
     # This can be called from the testing thread, so it needs to acquire the
     # global lock.
     def wait_for_buverack(self):
-        while True:
-            with mininode_lock:
-                if self.buverack_received:
-                    return
-            time.sleep(0.05)
+        wait_until(lambda: self.buverack_received)
 
     def clear_last_announcement(self):
         with mininode_lock:
@@ -205,33 +201,23 @@ class BUProtocolHandler(NodeConnCB):
 
     # Syncing helpers
     def sync(self, test_function, timeout=60):
-        while timeout > 0:
-            with mininode_lock:
-                if test_function():
-                    return
-
-            time.sleep(self.sleep_time)
-            timeout -= self.sleep_time
-        raise AssertionError("Sync failed to complete")
+        if not wait_until(test_function, timeout=timeout):
+            raise AssertionError("Sync failed to complete")
 
     # The request manager does not deal with vectors of GETDATA requests but rather one GETDATA per
     # hash, therefore we need to be able to sync_getdata one message at a time rather than in batches.
     def sync_getdata(self, hash_list, timeout=60):
-        while timeout > 0:
-            with mininode_lock:
-                # Check whether any getdata responses are in the hash list and
-                # if so remove them from both lists.
-                for x in self.last_getdata:
-                    for y in hash_list:
-                        if (str(x.inv).find(hex(y)[2:]) > 0):
-                            self.last_getdata.remove(x)
-                            hash_list.remove(y)
-                if hash_list == []:
-                    return
-
-            time.sleep(self.sleep_time)
-            timeout -= self.sleep_time
-        raise AssertionError("Sync getdata failed to complete")
+        def test_function():
+            # Check whether any getdata responses are in the hash list and
+            # if so remove them from both lists.
+            for x in self.last_getdata:
+                for y in hash_list:
+                    if (str(x.inv).find(hex(y)[2:]) > 0):
+                        self.last_getdata.remove(x)
+                        hash_list.remove(y)
+            return hash_list == []
+        if not wait_until(test_function, timeout=timeout):
+            raise AssertionError("Sync getdata failed to complete")
 
     def sync_with_ping(self, timeout=60):
         self.send_message(msg_ping(nonce=self.ping_counter))
@@ -332,7 +318,7 @@ class TestClass(BitcoinTestFramework):
 
         # first create addrs
         self.nodes[0].keypoolrefill(100)
-        addrs = [self.nodes[0].getnewaddress() for _ in range(100)]
+        addrs = get_new_addresses(self.nodes[0], 100)
         self.createUtxos(self.nodes[0], addrs, 100)
 
         # now create the python BU node
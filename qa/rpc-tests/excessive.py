@@ -15,6 +15,8 @@ import random
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal
 from test_framework.util import *
+from test_framework.utxoset import UtxoSet
+from test_framework.signer import TxSigner, node_forkid
 from test_framework.blocktools import *
 import test_framework.script as script
 import pdb
@@ -44,7 +46,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
           TEST_SIZE=100 # TMP 00
           print("Creating addresses...")
           self.nodes[0].keypoolrefill(TEST_SIZE+1)
-          addrs = [ self.nodes[0].getnewaddress() for _ in range(TEST_SIZE+1)]
+          addrs = get_new_addresses(self.nodes[0], TEST_SIZE+1)
           with open("walletAddrs.json","w") as f: 
             f.write(str(addrs))
             pdb.set_trace()
@@ -109,7 +111,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         loop = 0
         count = []
         while loop < waittime:
-            counts = [ x.getblockcount() for x in self.nodes ]
+            counts = NodeGroup(self.nodes).getblockcount()
             if counts == blockHeights: return True # success!
             time.sleep(1)
             loop += 1
@@ -153,7 +155,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
 
       logging.info("Creating addresses...")
       self.nodes[0].keypoolrefill(NUM_ADDRS)
-      addrs = [ self.nodes[0].getnewaddress() for _ in range(NUM_ADDRS)]
+      addrs = get_new_addresses(self.nodes[0], NUM_ADDRS)
 
       # test that a < 1MB block ignores the sigops parameter
       self.nodes[0].setminingmaxblock(1000000)
@@ -192,7 +194,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
               logging.info("...working %d" % blkLen)
               lastPrint=blkLen
 
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         base = counts[0]
 
         self.nodes[0].generate(1)
@@ -260,14 +262,14 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         
         self.sync_all()
         # verify mempool is cleaned up on all nodes
-        mbefore = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+        mbefore = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
         assert_equal(mbefore,[(0, 0)]*4)
 
 
         if 1:
           logging.info("Creating addresses...")
           self.nodes[0].keypoolrefill(TEST_SIZE+1)
-          addrs = [ self.nodes[0].getnewaddress() for _ in range(TEST_SIZE+1)]
+          addrs = get_new_addresses(self.nodes[0], TEST_SIZE+1)
         else:  # enable if you are using a pre-created wallet, as described above
           logging.info("Loading addresses...")
           with open("wallet10kAddrs.json") as f: addrs = json.load(f)
@@ -285,48 +287,45 @@ class ExcessiveBlockTest (BitcoinTestFramework):
           self.nodes[2].setminingmaxblock(1000000)
           self.nodes[3].setminingmaxblock(1000000)
              
-          wallet = self.nodes[0].listunspent()
-          wallet.sort(key=lambda x: x["amount"],reverse=True)
-          while len(wallet) < 3000:
+          utxos = UtxoSet(self.nodes[0])
+          while len(utxos) < 3000:
             # Create a LOT of UTXOs
             logging.info("Create lots of UTXOs...")
             n=0
             group = min(100, TEST_SIZE)
             count = 0
-            for w in wallet:
+            while len(utxos):
               count += 1
               # print count, " ",
-              split_transaction(self.nodes[0], [w], addrs[n:group+n])
+              (tx, vin, vout, txid) = split_transaction(self.nodes[0], [utxos.pop_largest()], addrs[n:group+n])
+              utxos.add_transaction(txid)
               n+=group
               if n >= len(addrs): n=0
               if count > 50:  # We don't need any more
                 break
             self.sync_all()
             logging.info("mine blocks")
-            self.nodes[0].generate(5)  # mine all the created transactions
+            utxos.add_blocks(self.nodes[0].generate(5))  # mine all the created transactions
             logging.info("sync all blocks and mempools")
             self.sync_all()
 
-            wallet = self.nodes[0].listunspent()
-            wallet.sort(key=lambda x: x["amount"],reverse=True)
-
           logging.info("clean out the mempool")
-          mbefore = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+          mbefore = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
           while mbefore != [(0, 0)]*4:
             time.sleep(1)
-            self.nodes[0].generate(1)
+            utxos.add_blocks(self.nodes[0].generate(1))
             time.sleep(10)
-            mbefore = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+            mbefore = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
           
           assert_equal(mbefore,[(0, 0)]*4)  # we need the mempool to be empty to track that this one tx doesn't prop
 
           logging.info("Test not relaying a large transaction")
 
-          (tx, vin, vout, txid) = split_transaction(self.nodes[0],wallet[0:3000],[addrs[0]],txfeePer=60)
+          (tx, vin, vout, txid) = split_transaction(self.nodes[0],utxos.largest(3000),[addrs[0]],txfeePer=60)
           logging.debug("Transaction Length is: ", len(binascii.unhexlify(tx)))
           assert(len(binascii.unhexlify(tx)) > 100000) # txn has to be big for the test to work
         
-          mbefore = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+          mbefore = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
           assert_equal(mbefore[1:],[(0, 0), (0, 0), (0, 0)])  # verify that the transaction did not propagate
           assert(mbefore[0][0] > 0) # verify that the transaction is in my node
 
@@ -339,7 +338,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
           logging.info("Test a large transaction in block < 1MB")
           largeBlock = self.nodes[0].generate(1)
           self.sync_blocks()
-          counts = [ x.getblockcount() for x in self.nodes ]
+          counts = NodeGroup(self.nodes).getblockcount()
           latest = counts[0]
           assert_equal(counts, [latest,latest,latest,latest]) # Verify that all nodes accepted the block, even if some of them didn't have the transaction.  They should all accept a <= 1MB block with a tx <= 1MB
 
@@ -347,16 +346,19 @@ class ExcessiveBlockTest (BitcoinTestFramework):
 
           logging.info("Creating addresses...")
           self.nodes[0].keypoolrefill(2000)
-          addrs = [ self.nodes[0].getnewaddress() for _ in range(2000)]
+          addrs = get_new_addresses(self.nodes[0], 2000)
           # Create a LOT of UTXOs for the next test
-          wallet = self.nodes[0].listunspent()
-          wallet.sort(key=lambda x: x["amount"],reverse=True)
-          wlen = len(wallet)
+          utxos = UtxoSet(self.nodes[0])
+          # sign locally; keys of coins mined later are fetched on demand
+          signer = TxSigner(node_forkid(self.nodes[0]), node=self.nodes[0])
+          signer.import_keys(self.nodes[0], set(addrs) | set(u["address"] for u in utxos))
+          wlen = len(utxos)
           while wlen < 8000:
             logging.info("Create lots of UTXOs by 100...")
             n=0  
-            for w in wallet:
-                split_transaction(self.nodes[0], [w], addrs[n:100+n])
+            while len(utxos):
+                (tx, vin, vout, txid) = split_transaction(self.nodes[0], [utxos.pop_largest()], addrs[n:100+n], signer=signer)
+                utxos.add_transaction(txid)
                 logging.info(str(wlen))
                 n+=100
                 if n >= len(addrs): n=0
@@ -364,33 +366,30 @@ class ExcessiveBlockTest (BitcoinTestFramework):
                 if wlen > 8000: break
 
             blk = self.nodes[0].generate(1)
+            utxos.add_blocks(blk)
             blkinfo = self.nodes[0].getblock(blk[0])                        
             logging.info("Generated block %d size: %d, num tx: %d" % (blkinfo["height"], blkinfo["size"], len(blkinfo["tx"])))
-            wallet = self.nodes[0].listunspent()
-            wallet.sort(key=lambda x: x["amount"],reverse=True)
-            wlen = len(wallet)
+            wlen = len(utxos)
             
 
-          self.nodes[0].generate(1)
+          utxos.add_blocks(self.nodes[0].generate(1))
           self.sync_all()
 
           logging.info("Building > 1MB block...")
           self.nodes[0].set("net.excessiveTx=1000000")  # Set the excessive transaction size larger for this node so we can generate an "excessive" block for the other nodes
         
-          wallet = self.nodes[0].listunspent()
-          wallet.sort(key=lambda x: x["amount"],reverse=False)
-          logging.info("Wallet length is %d" % len(wallet))
+          logging.info("Wallet length is %d" % len(utxos))
            
           # Generate 1 MB worth of transactions        
           size = 0
           count = 0
           while size < 1000000:
             count+=1
-            utxo = wallet.pop()
+            utxo = utxos.pop_largest()
             outp = {}
             outp[addrs[count%len(addrs)]] = utxo["amount"]
             txn = self.nodes[0].createrawtransaction([utxo], outp)
-            signedtxn = self.nodes[0].signrawtransaction(txn)
+            signedtxn = signer.signrawtransaction(txn, [utxo])
             size += len(binascii.unhexlify(signedtxn["hex"]))
             self.nodes[0].sendrawtransaction(signedtxn["hex"])
 
@@ -399,23 +398,22 @@ class ExcessiveBlockTest (BitcoinTestFramework):
           self.nodes[0].setminingmaxblock(2000000)
           self.nodes[0].set("net.excessiveBlock=2000000")
 
-          wallet.sort(key=lambda x: x["amount"],reverse=True)
-          (tx, vin, vout, txid) = split_transaction(self.nodes[0],wallet[0:2500],[addrs[0]],txfeePer=60)
+          (tx, vin, vout, txid) = split_transaction(self.nodes[0],utxos.largest(2500),[addrs[0]],txfeePer=60,signer=signer)
           logging.debug("Transaction Length is: ", len(binascii.unhexlify(tx)))
           assert(len(binascii.unhexlify(tx)) > 100000) # txn has to be big for the test to work
 
           origCounts = [ x.getblockcount() for x in self.nodes ]
           base = origCounts[0]
-          mpool = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+          mpool = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
           logging.debug(str(mpool))
           largeBlock = self.nodes[0].generate(1)
-          mpool = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+          mpool = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
           logging.debug(str(mpool))
 
           logging.info("Syncing node1")
           largeBlock2 = self.nodes[0].generate(1)
           sync_blocks(self.nodes[0:2])
-          mpool = [ (lambda y: (y["size"],y["bytes"]))(x.getmempoolinfo()) for x in self.nodes]
+          mpool = [ (y["size"],y["bytes"]) for y in NodeGroup(self.nodes).getmempoolinfo() ]
           logging.debug(str(mpool))
           self.expectHeights([base+2,base+2, base, base],30)
 
@@ -462,30 +460,30 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         logging.info("Test excessively sized block, not propagating until accept depth is exceeded")
         addr = self.nodes[3].getnewaddress()
         self.repeatTx(20,self.nodes[0],addr)
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         base = counts[0]
         logging.info("node0")
         self.nodes[0].generate(1)
         time.sleep(2) #give blocks a chance to fully propagate
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+1,base,base,base])  
 
         logging.info("node1")
         self.nodes[0].generate(1)
         sync_blocks(self.nodes[0:2])
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+2,base+2,base,base])  
 
         logging.info("node2")
         self.nodes[0].generate(1)
         sync_blocks(self.nodes[0:3])
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+3,base+3,base+3,base])  
 
         logging.info("node3")
         self.nodes[0].generate(1)
         self.sync_all()
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+4]*4)  
 
         # Now generate another excessive block, but all nodes should snap right to it because they have an older excessive block
@@ -493,7 +491,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         self.repeatTx(20,self.nodes[0],addr)
         self.nodes[0].generate(1)
         self.sync_all()
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+5]*4)  
       
         logging.info("Test daily excessive reset")
@@ -506,7 +504,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         base = self.nodes[0].getblockcount()
         self.nodes[0].generate(1)
         time.sleep(2) #give blocks a chance to fully propagate
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         #assert_equal(counts, [base+1,349,349,349])  
         assert_equal(counts, [base+1,base,base,base])  
 
@@ -514,26 +512,26 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         self.nodes[0].generate(1)
         time.sleep(2) #give blocks a chance to fully propagate
         sync_blocks(self.nodes[0:2])
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+2,base+2,base,base])  
 
         self.repeatTx(20,self.nodes[0],addr)
         self.nodes[0].generate(1)
         time.sleep(2) #give blocks a chance to fully propagate
         sync_blocks(self.nodes[0:3])
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+3,base+3,base+3,base])  
 
         self.repeatTx(20,self.nodes[0],addr)
         self.nodes[0].generate(1)
         self.sync_all()
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+4]*4)  
 
         self.repeatTx(20,self.nodes[0],addr)
         self.nodes[0].generate(1)
         self.sync_all()
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+5]*4)  
 
         logging.info("Test daily excessive reset #2")
@@ -549,7 +547,7 @@ class ExcessiveBlockTest (BitcoinTestFramework):
         self.nodes[0].generate(1)
         time.sleep(2) #give blocks a chance to fully propagate
         sync_blocks(self.nodes[0:2])
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [base+1,base+1,base,base])
         
         logging.info("Random test")
@@ -45,8 +45,8 @@ class ParallelTest (BitcoinTestFramework):
             send_to = {}
             n.keypoolrefill(100)
             n.keypoolrefill(100)
-            for i in range(200):
-              send_to[n.getnewaddress()] = Decimal("0.01")
+            for addr in get_new_addresses(n, 200):
+              send_to[addr] = Decimal("0.01")
             n.sendmany("", send_to)
 
             self.sync_all()
@@ -283,7 +283,7 @@ class ParallelTest (BitcoinTestFramework):
         sync_blocks(self.nodes)
         assert_equal(self.nodes[1].getbestblockhash(), self.nodes[2].getbestblockhash())
         assert_equal(self.nodes[0].getbestblockhash(), self.nodes[1].getbestblockhash())
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [205,205,205,205])  
 
         #stop nodes
@@ -352,7 +352,7 @@ class ParallelTest (BitcoinTestFramework):
         self.nodes[3].generate(1)
         self.nodes[4].generate(1)
         self.nodes[5].generate(1)
-        counts = [ x.getblockcount() for x in self.nodes ]
+        counts = NodeGroup(self.nodes).getblockcount()
         assert_equal(counts, [331,330,331,331,331,331])  
 
         # Connect nodes so that all blocks are sent at same time to node1. Largest block from node0 will be terminated.
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+asyncio based JSON-RPC client with the same call surface as AuthServiceProxy:
+
+    proxy = AsyncAuthServiceProxy(url)
+    count = await proxy.getblockcount()
+    hashes = await asyncio.gather(*[proxy.getblockhash(i) for i in range(100)])
+
+Unlike AuthServiceProxy, which owns a single HTTP connection and can only
+have one request in flight, every proxy keeps a pool of up to
+max_connections keep-alive connections, so a single test thread can drive
+many concurrent RPCs against a node.  Requests beyond that wait for a free
+connection.
+
+The connections belong to the event loop they were opened on; call
+close() before that loop finishes.  Use util.get_async_rpc_proxy() to get a
+proxy that also records coverage like get_rpc_proxy() does.
+"""
+import asyncio
+import base64
+import decimal
+import itertools
+import json
+import logging
+import urllib.parse as urlparse
+
+from .authproxy import JSONRPCException, EncodeDecimal, HTTP_TIMEOUT
+
+USER_AGENT = "AsyncAuthServiceProxy/0.1"
+
+# Default number of simultaneous HTTP connections per proxy
+MAX_CONNECTIONS = 16
+
+log = logging.getLogger("BitcoinRPC")
+
+# Request ids, unique across proxies, threads and event loops
+_ids = itertools.count(1)
+
+
+class StaleConnectionError(ConnectionResetError):
+    """The connection ended before any of the response was read"""
+    pass
+
+
+class AsyncAuthServiceProxy(object):
+    r"""
+    Against a stub JSON-RPC server that answers [method, 0.1] and drops
+    every connection after its third request:
+
+    >>> connections = []
+    >>> async def serve(reader, writer):
+    ...     connections.append(writer)
+    ...     try:
+    ...         for n in range(3):
+    ...             head = await reader.readuntil(b"\r\n\r\n")
+    ...             length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    ...             request = json.loads((await reader.readexactly(length)).decode())
+    ...             body = json.dumps({"result": [request["method"], 0.1], "error": None,
+    ...                                "id": request["id"]}).encode()
+    ...             writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+    ...                          b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    ...     except asyncio.IncompleteReadError:  # closed by the proxy
+    ...         pass
+    ...     writer.close()
+    >>> async def main():
+    ...     server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    ...     port = server.sockets[0].getsockname()[1]
+    ...     proxy = AsyncAuthServiceProxy("http://u:p@127.0.0.1:%d" % port, max_connections=2)
+    ...     first = await asyncio.gather(*[proxy.getblockcount() for i in range(4)])
+    ...     # both connections have served 2 requests; the third closes them
+    ...     await asyncio.gather(*[proxy.getbestblockhash() for i in range(2)])
+    ...     await asyncio.sleep(0.1)
+    ...     last = await proxy.getblockhash(0)
+    ...     await proxy.close()
+    ...     server.close()
+    ...     await server.wait_closed()
+    ...     return (first[0], last, len(connections))
+    >>> asyncio.run(main())
+    (['getblockcount', Decimal('0.1')], ['getblockhash', Decimal('0.1')], 3)
+    """
+    def __init__(self, service_url, timeout=HTTP_TIMEOUT, max_connections=MAX_CONNECTIONS, ensure_ascii=True):
+        self.url = service_url
+        self.timeout = timeout
+        self.ensure_ascii = ensure_ascii
+        self.__url = urlparse.urlparse(service_url)
+        self.__port = self.__url.port or 80
+        authpair = ("%s:%s" % (self.__url.username, self.__url.password)).encode('utf8')
+        self.__auth_header = 'Basic ' + base64.b64encode(authpair).decode('ascii')
+        self.__idle = []   # (reader, writer) pairs ready for reuse
+        self.__max_connections = max_connections
+        self.__slots = None
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        async def rpc_call(*args):
+            return await self.call(name, *args)
+        rpc_call.__name__ = name
+        return rpc_call
+
+    async def call(self, method, *args):
+        """Call RPC 'method' with 'args' and return its result"""
+        rpc_id = next(_ids)
+        postdata = json.dumps({'version': '1.1',
+                               'method': method,
+                               'params': args,
+                               'id': rpc_id}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+        log.debug("-%s-> %s %s" % (rpc_id, method, postdata))
+        response = await self._request(postdata.encode('utf-8'))
+        if response.get('error') is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        return response['result']
+
+    async def close(self):
+        """Close all idle connections"""
+        while self.__idle:
+            (reader, writer) = self.__idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _request(self, body):
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.__max_connections)
+        async with self.__slots:
+            if self.__idle:
+                # A keep-alive connection may have been closed by the server
+                # while idle, which shows as the connection ending before
+                # any response arrives.  Only then is it safe to send the
+                # request again on a fresh connection: once a response has
+                # started, the node has acted on it (sendrawtransaction,
+                # generate...).
+                try:
+                    return await asyncio.wait_for(self._request_once(body, self.__idle.pop()), self.timeout)
+                except StaleConnectionError:
+                    pass
+            connection = await asyncio.open_connection(self.__url.hostname, self.__port,
+                                                       ssl=(self.__url.scheme == 'https') or None)
+            return await asyncio.wait_for(self._request_once(body, connection), self.timeout)
+
+    async def _request_once(self, body, connection):
+        (reader, writer) = connection
+        try:
+            headers = ("POST %s HTTP/1.1\r\n"
+                       "Host: %s\r\n"
+                       "User-Agent: %s\r\n"
+                       "Authorization: %s\r\n"
+                       "Content-type: application/json\r\n"
+                       "Content-Length: %d\r\n"
+                       "Connection: keep-alive\r\n\r\n"
+                       % (self.__url.path or '/', self.__url.hostname, USER_AGENT,
+                          self.__auth_header, len(body)))
+            writer.write(headers.encode('ascii') + body)
+            (status, reason, response_headers, data, keep_alive) = await self._read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            self.__idle.append((reader, writer))
+        else:
+            writer.close()
+
+        if response_headers.get('content-type') != 'application/json':
+            raise JSONRPCException({
+                'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (status, reason)})
+        responsedata = data.decode('utf8')
+        log.debug("<-- " + responsedata)
+        return json.loads(responsedata, parse_float=decimal.Decimal)
+
+    @staticmethod
+    async def _read_response(reader):
+        try:
+            status_line = await reader.readline()
+        except ConnectionError as e:
+            raise StaleConnectionError(str(e))
+        if not status_line:
+            raise StaleConnectionError("connection closed by server")
+        (version, status, reason) = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (key, value) = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+            keep_alive = True
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+            keep_alive = True
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+            keep_alive = False
+        return (int(status), reason, headers, data, keep_alive)
@@ -6,12 +6,14 @@ AuthServiceProxy has the following improvements over python-jsonrpc's
 ServiceProxy class:
 
 - HTTP connections persist for the life of the AuthServiceProxy object
-(if server supports HTTP/1.1)
+(if server supports HTTP/1.1), in a thread-safe pool shared by all its
+method callables
 - sends protocol 'version', per JSON-RPC 1.1
 - sends proper, incrementing 'id'
 - sends Basic HTTP authentication headers
 - parses all JSON numbers that look like floats as Decimal
 - uses standard Python json lib
+- sends JSON-RPC batches queued through batch()
 
 Previous copyright, from python-jsonrpc/jsonrpc/proxy.py:
 
@@ -40,8 +42,12 @@ except ImportError:
     import httplib
 import base64
 import decimal
+import itertools
 import json
 import logging
+import select
+import threading
+import time
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -51,8 +57,23 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+# Maximum number of calls an RPCBatch sends in one HTTP request
+BATCH_CHUNK_SIZE = 1000
+
+# Maximum number of HTTP connections a proxy opens to its node
+POOL_MAX_SIZE = 8
+# Idle connections older than this are reopened instead of reused; bitcoind
+# drops keep-alive connections after -rpcservertimeout (30 s by default)
+POOL_MAX_IDLE = 25
+# How often a request is resent after the connection broke before it was sent
+MAX_RETRIES = 3
+
 log = logging.getLogger("BitcoinRPC")
 
+# Request ids of all proxies; next() on it is atomic, so ids are unique
+# across threads
+_ids = itertools.count(1)
+
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
         Exception.__init__(self)
@@ -66,20 +87,186 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
-class AuthServiceProxy(object):
-    __id_count = 0
+class RPCFuture(object):
+    """Result of a call queued in an RPCBatch, available once the batch was sent"""
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def exception(self):
+        """The JSONRPCException of this call, or None if it succeeded"""
+        if self._error is None:
+            return None
+        return JSONRPCException(self._error)
+
+    def result(self):
+        """Return the result of the call, raising JSONRPCException if it failed"""
+        if not self._done:
+            raise RuntimeError("batch containing %s has not been sent yet" % self.method)
+        if self._error is not None:
+            raise JSONRPCException(self._error)
+        return self._result
+
+    def _set(self, result, error):
+        self._result = result
+        self._error = error
+        self._done = True
+
+
+class RPCBatch(object):
+    """
+    Collects RPC calls and sends them as JSON-RPC batches, e.g.
+
+        with node.batch() as b:
+            for i in range(1000):
+                b.getnewaddress()
+        addrs = b.results()
+
+    Every queued call returns an RPCFuture. The calls are sent when the
+    'with' block exits (or execute() is called), in requests of at most
+    chunk_size calls each.
+    """
+    def __init__(self, proxy, chunk_size=BATCH_CHUNK_SIZE, on_execute=None):
+        self._proxy = proxy
+        self._chunk_size = chunk_size
+        self._on_execute = on_execute
+        self.futures = []
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        return lambda *args: self.call(name, *args)
+
+    def call(self, method, *args):
+        """Queue a call to 'method' and return its RPCFuture"""
+        future = RPCFuture(method, args)
+        self.futures.append(future)
+        return future
+
+    def __len__(self):
+        return len(self.futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+    def execute(self):
+        """Send all queued calls that were not sent yet"""
+        pending = [f for f in self.futures if not f.done()]
+        for start in range(0, len(pending), self._chunk_size):
+            chunk = pending[start:start + self._chunk_size]
+            ids = [self._proxy._next_id() for f in chunk]
+            response = self._proxy._batch({'version': '1.1', 'method': f.method, 'params': f.params, 'id': i}
+                                          for (f, i) in zip(chunk, ids))
+            if not isinstance(response, list):
+                # the server rejected the batch as a whole
+                raise JSONRPCException(response.get('error') or {
+                    'code': -343, 'message': 'invalid JSON-RPC batch response'})
+            by_id = dict((r.get('id'), r) for r in response)
+            for (f, i) in zip(chunk, ids):
+                r = by_id.get(i)
+                if r is None:
+                    f._set(None, {'code': -343, 'message': 'missing JSON-RPC result'})
+                else:
+                    f._set(r.get('result'), r.get('error'))
+        if self._on_execute:
+            self._on_execute([f.method for f in pending])
+
+    @property
+    def errors(self):
+        """Map of call index to JSONRPCException for every failed call"""
+        return dict((i, f.exception()) for (i, f) in enumerate(self.futures)
+                    if f.done() and f.exception() is not None)
 
+    def results(self):
+        """Results of all calls in order. Raises the first call's JSONRPCException if any failed"""
+        return [f.result() for f in self.futures]
+
+
+class HTTPConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP connections to one server.
+
+    At most max_size connections exist at a time; acquire() blocks until one
+    is free. Idle connections are checked before they are handed out, and
+    ones the server has closed (or that sat idle for more than max_idle
+    seconds) are reopened.
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT, max_size=POOL_MAX_SIZE, max_idle=POOL_MAX_IDLE):
+        self.url = url
+        self.timeout = timeout
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._cond = threading.Condition()
+        self._idle = []   # (connection, time released), most recently used last
+        self._count = 0
+
+    def _new_connection(self):
+        port = self.url.port or 80
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.hostname, port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.sock is None:
+            return True   # not connected yet, will connect on the next request
+        if time.time() - idle_since > self.max_idle:
+            return False
+        # an idle keep-alive socket is only readable if the server closed it
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self):
+        with self._cond:
+            while not self._idle and self._count >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                (conn, idle_since) = self._idle.pop()
+            else:
+                conn = self._new_connection()
+                idle_since = time.time()
+                self._count += 1
+        if not self._is_healthy(conn, idle_since):
+            conn.close()
+        return conn
+
+    def release(self, conn, reuse=True):
+        """Return conn to the pool. Pass reuse=False if its state is unknown, e.g. after an error"""
+        if not reuse:
+            conn.close()
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        """Close all idle connections; they are reopened on demand"""
+        with self._cond:
+            for (conn, idle_since) in self._idle:
+                conn.close()
+
+
+class AuthServiceProxy(object):
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
-        self.__timeout = timeout
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True,
+                 pool_size=POOL_MAX_SIZE):
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii # can be toggled on the fly by tests
         self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
         (user, passwd) = (self.__url.username, self.__url.password)
         try:
             user = user.encode('utf8')
@@ -93,26 +280,13 @@ class AuthServiceProxy(object):
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
 
         if connection:
-            # Callables re-use the connection of the original proxy
-            self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  timeout=timeout)
+            # Callables re-use the connection pool of the original proxy
+            self.__pool = connection
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 timeout=timeout)
-    def reconnect(self):
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
+            self.__pool = HTTPConnectionPool(self.__url, timeout, pool_size)
 
-        if self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  timeout=self.__timeout)
-        else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 timeout=self.__timeout)
+    def reconnect(self):
+        self.__pool.close()
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -120,46 +294,52 @@ class AuthServiceProxy(object):
             raise AttributeError
         if self._service_name is not None:
             name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        return AuthServiceProxy(self.__service_url, name, connection=self.__pool)
 
     def _request(self, method, path, postdata):
         '''
-        Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
-        This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
+        Do a HTTP request on a pooled connection, resending it on a fresh
+        connection (at most MAX_RETRIES times) if the one we used could not
+        even be written to, e.g. because the server dropped it.  Once the
+        request is out it is never resent: the node may have acted on it
+        (sendrawtransaction, generate) before the connection broke.
         '''
         headers = {'Host': self.__url.hostname,
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
-        while 1:
-          try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-          except httplib.CannotSendRequest as e:
-            print("Cannot send request:", str(e))
-            self.reconnect()
-          except httplib.BadStatusLine as e:
-            if e.line == "''": # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
+        for attempt in range(MAX_RETRIES + 1):
+            conn = self.__pool.acquire()
+            try:
+                conn.request(method, path, postdata, headers)
+            except (httplib.CannotSendRequest, BrokenPipeError, ConnectionResetError):
+                self.__pool.release(conn, reuse=False)
+                if attempt == MAX_RETRIES:
+                    raise
+                continue
+            except:
+                self.__pool.release(conn, reuse=False)
+                raise
+            try:
+                response = self._get_response(conn)
+            except:
+                # timeouts, dropped connections, unexpected responses: the
+                # connection may still carry (part of) a reply, so it must
+                # not be reused
+                self.__pool.release(conn, reuse=False)
                 raise
-          except (BrokenPipeError, ConnectionResetError):
-            # Python 3.5+ raises this instead of BadStatusLine when the connection was reset
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            self.__pool.release(conn)
+            return response
 
     def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
+        rpc_id = AuthServiceProxy._next_id()
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self._service_name,
+        log.debug("-%s-> %s %s"%(rpc_id, self._service_name,
                                  json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         postdata = json.dumps({'version': '1.1',
                                'method': self._service_name,
                                'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+                               'id': rpc_id}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
         response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
@@ -169,13 +349,25 @@ class AuthServiceProxy(object):
         else:
             return response['result']
 
+    @staticmethod
+    def _next_id():
+        return next(_ids)
+
+    def batch(self, chunk_size=BATCH_CHUNK_SIZE, on_execute=None):
+        """
+        Return an RPCBatch that sends calls queued on it through this proxy
+        in as few HTTP requests as possible. on_execute, if given, is called
+        with the list of method names each time the batch is sent.
+        """
+        return RPCBatch(self, chunk_size, on_execute)
+
     def _batch(self, rpc_call_list):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
         log.debug("--> "+postdata)
         return self._request('POST', self.__url.path, postdata.encode('utf-8'))
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+    def _get_response(self, conn):
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
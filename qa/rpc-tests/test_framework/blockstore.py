@@ -2,139 +2,472 @@
 # BlockStore: a helper class that keeps a map of blocks and implements
 #             helper functions for responding to getheaders and getdata,
 #             and for constructing a getheaders message
+# TxStore: the same for transactions
+#
+# Both keep their data in an AppendOnlyStore, a file of records that is
+# only ever appended to and is read back through mmap.
 #
 
 from .mininode import *
-from io import BytesIO
-import dbm.ndbm
+from collections import OrderedDict
+import mmap
+import os
+import struct
+import threading
+
+# record header: 32 byte key, u32 payload length
+struct_record = struct.Struct("<32sI")
+
+# Default sizes of the caches of parsed, ready to send blocks and transactions
+BLOCK_CACHE_BYTES = 64 * 1024 * 1024
+TX_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class LRUCache(object):
+    """
+    Keeps the most recently used values up to a total of max_bytes, as
+    given by the size passed to put() for each value.
+
+    >>> c = LRUCache(10)
+    >>> c.put("a", 1, 4); c.put("b", 2, 4)
+    >>> c.get("a")
+    1
+    >>> c.put("c", 3, 4)
+    >>> (c.get("b"), "a" in c, "c" in c)
+    (None, True, True)
+    >>> sorted(c.stats().items())
+    [('bytes', 8), ('entries', 2), ('evictions', 1), ('hits', 1), ('misses', 1)]
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                (value, size) = self.entries.popitem(last=False)[1]
+                self.bytes -= size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.bytes}
+
+
+class AppendOnlyStore(object):
+    """
+    Maps raw 32 byte keys to byte strings.  Records are appended to
+    'filename' and the file is mapped into memory for reading, so reads
+    return memoryviews of the mapping without copying.  The index lives
+    in memory; a key that is stored again points to its newest record.
+
+    With persist=True an existing file is reopened and its index rebuilt,
+    otherwise the file starts out empty.
+    """
+    def __init__(self, filename, persist=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.index = {}  # key -> (offset of the data, length)
+        self.last_key = None
+        self.file = open(filename, "a+b" if persist else "w+b", buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+        self.remap()
+        pos = 0
+        while pos + struct_record.size <= self.size:
+            (key, length) = struct_record.unpack_from(self.map, pos)
+            if pos + struct_record.size + length > self.size:
+                break  # torn write at the end of the file
+            pos += struct_record.size
+            self.index[key] = (pos, length)
+            self.last_key = key
+            pos += length
+        if pos < self.size:
+            # cut off the torn record, or records appended from now on
+            # would be lost behind it the next time the file is opened
+            self.map = None
+            self.file.truncate(pos)
+            self.size = pos
+            self.remap()
+
+    def remap(self):
+        # views of the old mapping that are still in use keep it alive
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        with self.lock:
+            self.index = {}
+            self.map = None
+            self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def put(self, key, data):
+        self.put_many([(key, data)])
+
+    def put_many(self, items):
+        """Append (key, data) pairs with a single write"""
+        chunks = []
+        entries = []
+        with self.lock:
+            pos = self.size
+            for (key, data) in items:
+                chunks.append(struct_record.pack(key, len(data)))
+                chunks.append(data)
+                pos += struct_record.size
+                entries.append((key, (pos, len(data))))
+                pos += len(data)
+            if not entries:
+                return
+            self.file.write(b"".join(chunks))
+            self.size = pos
+            self.index.update(entries)
+            self.last_key = entries[-1][0]
+
+    def get(self, key, length=None):
+        """A memoryview of the data stored under key (at most 'length' bytes of it), or None"""
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        (pos, n) = entry
+        if length is not None:
+            n = min(n, length)
+        with self.lock:
+            if self.map is None or len(self.map) < pos + n:
+                self.remap()
+            return memoryview(self.map)[pos:pos + n]
+
+
+def skip_height(height):
+    """
+    Height of the block that the skip pointer of the block at 'height'
+    points to, chosen like bitcoind's GetSkipHeight so that any ancestor
+    is reached in O(log n) steps
+    """
+    if height < 2:
+        return 0
+    if height & 1:
+        # clear the lowest set bit of height - 1, twice
+        h = height - 1
+        h &= h - 1
+        return (h & (h - 1)) + 1
+    return height & (height - 1)
+
+
+class HeaderIndexEntry(object):
+    __slots__ = ("header", "height", "parent", "skip")
+
+    def __init__(self, header, parent):
+        self.header = header
+        self.parent = parent
+        self.set_height()
+
+    def set_height(self):
+        if self.parent is None:
+            self.height = 0
+            self.skip = None
+        else:
+            self.height = self.parent.height + 1
+            self.skip = self.parent.get_ancestor(skip_height(self.height))
+
+    def get_ancestor(self, height):
+        """The entry at 'height' on the way back from this one, or None"""
+        if height > self.height or height < 0:
+            return None
+        entry = self
+        while entry.height != height:
+            skip_to = skip_height(entry.height)
+            if entry.skip is not None and skip_to >= height:
+                entry = entry.skip
+            else:
+                entry = entry.parent
+        return entry
+
+
+class HeaderIndex(object):
+    """
+    All known headers, each with its height, parent and a skip pointer to
+    an ancestor further back.  Heights count from the oldest header whose
+    parent is known; a header that arrives before its parent is attached
+    once the parent is added.
+
+    >>> index = HeaderIndex()
+    >>> headers = [CBlockHeader() for i in range(20)]
+    >>> for (i, h) in enumerate(headers):
+    ...     h.nNonce = i
+    ...     h.hashPrevBlock = headers[i - 1].sha256 if i else 0
+    ...     h.calc_sha256()
+    >>> for h in headers[10:] + headers[:10]:
+    ...     entry = index.add(h)
+    >>> tip = index.get_entry(headers[-1].sha256)
+    >>> (tip.height, tip.get_ancestor(3).header is headers[3])
+    (19, True)
+    """
+    def __init__(self):
+        self.entries = {}
+        self.orphans = {}  # hash of a missing parent -> entries waiting for it
+        self.children = {}  # hash -> entries whose parent it is
+
+    def __contains__(self, blockhash):
+        return blockhash in self.entries
+
+    def get_entry(self, blockhash):
+        return self.entries.get(blockhash)
+
+    def get(self, blockhash):
+        entry = self.entries.get(blockhash)
+        return None if entry is None else entry.header
+
+    def add(self, header):
+        header.calc_sha256()
+        entry = self.entries.get(header.sha256)
+        if entry is not None:
+            entry.header = header
+            return entry
+        entry = HeaderIndexEntry(header, self.entries.get(header.hashPrevBlock))
+        self.entries[header.sha256] = entry
+        if entry.parent is None:
+            self.orphans.setdefault(header.hashPrevBlock, []).append(entry)
+        else:
+            self.children.setdefault(header.hashPrevBlock, []).append(entry)
+        # adopt the headers that were waiting for this one; the heights of
+        # everything below them change
+        adopted = self.orphans.pop(header.sha256, [])
+        self.children.setdefault(header.sha256, []).extend(adopted)
+        stack = []
+        for child in adopted:
+            child.parent = entry
+            stack.append(child)
+        while stack:
+            e = stack.pop()
+            e.set_height()
+            stack.extend(self.children.get(e.header.sha256, []))
+        return entry
+
+    def locator(self, tip):
+        """
+        The hashPrevBlock of the tip and of headers further back, one by one
+        for the first 11 and then with a step that doubles every time
+        """
+        r = []
+        entry = self.entries.get(tip)
+        step = 1
+        while entry is not None:
+            r.append(entry.header.hashPrevBlock)
+            entry = entry.get_ancestor(entry.height - step)
+            if len(r) > 10:
+                step *= 2
+        return r
+
+    def headers_after(self, tip, have, hash_stop, max_headers):
+        """
+        The headers from the last one in 'have' on the way back from 'tip'
+        (or the oldest known one) up to at most max_headers, ending early
+        at hash_stop
+        """
+        entry = self.entries.get(tip)
+        if entry is None:
+            return None
+        fork = entry.get_ancestor(0)
+        for h in have:
+            e = self.entries.get(h)
+            if e is not None and e.height > fork.height and entry.get_ancestor(e.height) is e:
+                fork = e
+        end = entry.get_ancestor(min(fork.height + max_headers - 1, entry.height))
+        headers = []
+        while end is not fork:
+            headers.append(end.header)
+            end = end.parent
+        headers.append(fork.header)
+        headers.reverse()
+        for (i, h) in enumerate(headers):
+            if h.sha256 == hash_stop:
+                return headers[:i + 1]
+        return headers
+
 
 class BlockStore(object):
-    def __init__(self, datadir):
-        self.blockDB = dbm.ndbm.open(datadir + "/blocks", 'c')
+    """
+    Blocks are handed out from a cache of PreframedMessages of parsed
+    blocks; they are shared, so callers must not modify them.
+    """
+    def __init__(self, datadir, persist=False, cache_bytes=BLOCK_CACHE_BYTES):
+        self.blockDB = AppendOnlyStore(datadir + "/blocks.dat", persist)
+        self.cache = LRUCache(cache_bytes)
         self.currentBlock = 0
-        self.headers_map = dict()
-    
+        self.header_index = HeaderIndex()
+        for key in self.blockDB.keys():
+            self.add_header(self.read_header(key))
+        if self.blockDB.last_key is not None:
+            self.currentBlock = uint256_from_str(self.blockDB.last_key)
+
     def close(self):
         self.blockDB.close()
 
+    def contains(self, blockhash):
+        return ser_uint256(blockhash) in self.blockDB
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def get_message(self, blockhash):
+        """A PreframedMessage of msg_block for the block, or None"""
+        message = self.cache.get(blockhash)
+        if message is None:
+            serialized_block = self.blockDB.get(ser_uint256(blockhash))
+            if serialized_block is None:
+                return None
+            block = CLazyBlock()
+            block.deserialize(ByteReader(serialized_block))
+            block.calc_sha256()
+            message = PreframedMessage(msg_block(block))
+            self.cache.put(blockhash, message, len(message.data))
+        return message
+
     def get(self, blockhash):
-        serialized_block = None
-        try:
-            serialized_block = self.blockDB[repr(blockhash)]
-        except KeyError:
-            return None
-        f = BytesIO(serialized_block)
-        ret = CBlock()
-        ret.deserialize(f)
-        ret.calc_sha256()
-        return ret
+        message = self.get_message(blockhash)
+        return None if message is None else message.message.block
+
+    def read_header(self, key):
+        # only the first 80 bytes of the stored block are read
+        header = CBlockHeader()
+        header.deserialize(ByteReader(self.blockDB.get(key, 80)))
+        return header
 
     def get_header(self, blockhash):
-        try:
-            return self.headers_map[blockhash]
-        except KeyError:
-            return None
+        return self.header_index.get(blockhash)
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        headers = self.header_index.headers_after(current_tip, locator.vHave, hash_stop, 2000)
+        if headers is None:
             return None
-
         response = msg_headers()
-        headersList = [ current_block_header ]
-        maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
-                break
-        headersList = headersList[:maxheaders] # truncate if we have too many
-        hashList = [x.sha256 for x in headersList]
-        index = len(headersList)
-        if (hash_stop in hashList):
-            index = hashList.index(hash_stop)+1
-        response.headers = headersList[:index]
+        response.headers = headers
         return response
 
     def add_block(self, block):
-        block.calc_sha256()
-        try:
-            self.blockDB[repr(block.sha256)] = bytes(block.serialize())
-        except TypeError as e:
-            print("Unexpected error: ", sys.exc_info()[0], e.args)
-        self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
+        self.add_blocks([block])
+
+    def add_blocks(self, blocks):
+        """Store several blocks with one write; the last one becomes the current block"""
+        for block in blocks:
+            block.calc_sha256()
+        self.blockDB.put_many([(ser_uint256(block.sha256), block.serialize()) for block in blocks])
+        for block in blocks:
+            self.cache.discard(block.sha256)
+            self.currentBlock = block.sha256
+            self.header_index.add(CBlockHeader(block))
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        self.header_index.add(header)
 
     def get_blocks(self, inv):
         responses = []
         for i in inv:
             if (i.type == 2): # MSG_BLOCK
-                block = self.get(i.hash)
-                if block is not None:
-                    responses.append(msg_block(block))
+                message = self.get_message(i.hash)
+                if message is not None:
+                    responses.append(message)
         return responses
 
     def get_locator(self, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        r = []
-        counter = 0
-        step = 1
-        lastBlock = self.get(current_tip)
-        while lastBlock is not None:
-            r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get(lastBlock.hashPrevBlock)
-                if lastBlock is None:
-                    break
-            counter += 1
-            if counter > 10:
-                step *= 2
         locator = CBlockLocator()
-        locator.vHave = r
+        locator.vHave = self.header_index.locator(current_tip)
         return locator
 
+
 class TxStore(object):
-    def __init__(self, datadir):
-        self.txDB = dbm.ndbm.open(datadir + "/transactions", 'c')
+    """Like BlockStore, transactions are shared and must not be modified"""
+    def __init__(self, datadir, persist=False, cache_bytes=TX_CACHE_BYTES):
+        self.txDB = AppendOnlyStore(datadir + "/transactions.dat", persist)
+        self.cache = LRUCache(cache_bytes)
 
     def close(self):
         self.txDB.close()
 
+    def contains(self, txhash):
+        return ser_uint256(txhash) in self.txDB
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def get_message(self, txhash):
+        """A PreframedMessage of msg_tx for the transaction, or None"""
+        message = self.cache.get(txhash)
+        if message is None:
+            serialized_tx = self.txDB.get(ser_uint256(txhash))
+            if serialized_tx is None:
+                return None
+            tx = CTransaction()
+            tx.deserialize(ByteReader(serialized_tx))
+            tx.calc_sha256()
+            message = PreframedMessage(msg_tx(tx))
+            self.cache.put(txhash, message, len(message.data))
+        return message
+
     def get(self, txhash):
-        serialized_tx = None
-        try:
-            serialized_tx = self.txDB[repr(txhash)]
-        except KeyError:
-            return None
-        f = BytesIO(serialized_tx)
-        ret = CTransaction()
-        ret.deserialize(f)
-        ret.calc_sha256()
-        return ret
+        message = self.get_message(txhash)
+        return None if message is None else message.message.tx
 
     def add_transaction(self, tx):
-        tx.calc_sha256()
-        try:
-            self.txDB[repr(tx.sha256)] = bytes(tx.serialize())
-        except TypeError as e:
-            print("Unexpected error: ", sys.exc_info()[0], e.args)
+        self.add_transactions([tx])
+
+    def add_transactions(self, txs):
+        """Store several transactions with one write"""
+        for tx in txs:
+            tx.calc_sha256()
+        self.txDB.put_many([(ser_uint256(tx.sha256), tx.serialize_cached()) for tx in txs])
+        for tx in txs:
+            self.cache.discard(tx.sha256)
 
     def get_transactions(self, inv):
         responses = []
         for i in inv:
             if (i.type == 1): # MSG_TX
-                tx = self.get(i.hash)
-                if tx is not None:
-                    responses.append(msg_tx(tx))
+                message = self.get_message(i.hash)
+                if message is not None:
+                    responses.append(message)
         return responses
@@ -8,13 +8,14 @@ class msg_buversion(object):
         self.addrFromPort = addrFromPort
         pass
 
+    @reads_stream
     def deserialize(self, f):
-        self.addrFromPort = struct.unpack("<H", f.read(2))[0]
+        self.addrFromPort = f.read_u16()
         return self
 
     def serialize(self):
         r = b""
-        r += struct.pack("<H", self.addrFromPort)
+        r += struct_u16.pack(self.addrFromPort)
         return r
 
     def __repr__(self):
@@ -27,6 +28,7 @@ class msg_buverack(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         return self
 
@@ -40,17 +42,21 @@ class msg_buverack(object):
 
 class QHash(object):
     """quarter hash"""
+    __slots__ = ("hash",)
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
 
     def __init__(self, shortHash=None):
         self.hash = shortHash
 
+    @reads_stream
     def deserialize(self, f):
-        self.hash = struct.unpack("<Q", f.read(8))[0]
+        self.hash = f.read_u64()
         return self
 
     def serialize(self):
         r = b""
-        r += struct.pack("<Q", self.hash)
+        r += struct_u64.pack(self.hash)
         return r
 
     def __repr__(self):
@@ -59,12 +65,16 @@ class QHash(object):
 
 class Hash(object):
     """sha256 hash"""
+    __slots__ = ("hash",)
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
 
     def __init__(self, hash=None):
         self.hash = hash
 
+    @reads_stream
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
+        self.hash = f.read_uint256()
         return self
 
     def serialize(self):
@@ -85,6 +95,7 @@ class CXThinBlock(CBlockHeader):
         self.vTxHashes = vTxHashes
         self.vMissingTx = vMissingTx
 
+    @reads_stream
     def deserialize(self, f):
         super(CXThinBlock, self).deserialize(f)
         self.vTxHashes = deser_vector(f, QHash)
@@ -138,6 +149,7 @@ class CThinBlock(CBlockHeader):
         self.vTxHashes = []
         self.vMissingTx = []
 
+    @reads_stream
     def deserialize(self, f):
         super(self.__class__, self).deserialize(f)
         self.vTxHashes = deser_vector(f, Hash)
@@ -174,19 +186,20 @@ class CBloomFilter:
         self.nTweak = None
         self.nFlags = None
 
+    @reads_stream
     def deserialize(self, f):
-        self.vData = deser_string(f)
-        self.nHashFuncs = struct.unpack("<I", f.read(4))[0]
-        self.nTweak = struct.unpack("<I", f.read(4))[0]
-        self.nFlags = struct.unpack("<B", f.read(1))[0]
+        self.vData = f.read_string()
+        self.nHashFuncs = f.read_u32()
+        self.nTweak = f.read_u32()
+        self.nFlags = f.read_u8()
         return self
 
     def serialize(self):
         r = b""
         r += ser_string(f, self.vData)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
+        r += struct_u32.pack(self.nHashFuncs)
+        r += struct_u32.pack(self.nTweak)
+        r += struct_u8.pack(self.nFlags)
         return r
 
     def __repr__(self):
@@ -202,6 +215,7 @@ class msg_thinblock(object):
         else:
             self.block = block
 
+    @reads_stream
     def deserialize(self, f):
         self.block.deserialize(f)
         return self
@@ -225,6 +239,7 @@ class msg_xthinblock(object):
         else:
             self.block = block
 
+    @reads_stream
     def deserialize(self, f):
         self.block.deserialize(f)
         return self
@@ -250,9 +265,10 @@ class msg_Xb(object):
         self.hops = hops
         self.block = block
 
+    @reads_stream
     def deserialize(self, f):
-        self.msgType = struct.unpack("<B", f.read(1))[0]
-        self.hops = struct.unpack("<B", f.read(1))[0]
+        self.msgType = f.read_u8()
+        self.hops = f.read_u8()
         if self.msgType == EXPEDITED_MSG_XTHIN:
             self.block = CXThinBlock()
             self.block.deserialize(f)
@@ -262,8 +278,8 @@ class msg_Xb(object):
 
     def serialize(self):
         r = b""
-        r += struct.pack("<B", self.msgType)
-        r += struct.pack("<B", self.hops)
+        r += struct_u8.pack(self.msgType)
+        r += struct_u8.pack(self.hops)
         if self.msgType == EXPEDITED_MSG_XTHIN:
             r += self.block.serialize()
         return r
@@ -282,6 +298,7 @@ class msg_get_xthin(object):
         self.inv = inv
         self.filter = filter
 
+    @reads_stream
     def deserialize(self, f):
         self.inv = CInv()
         self.inv.deserialize(f)
@@ -305,6 +322,7 @@ class msg_filterload(object):
     def __init__(self, inv=None, filter=None):
         self.filter = filter
 
+    @reads_stream
     def deserialize(self, f):
         self.filter = CBloomFilter()
         self.filter.deserialize(f)
@@ -325,8 +343,9 @@ class msg_filteradd(object):
     def __init__(self, inv=None, filter=None):
         self.filter = filter
 
+    @reads_stream
     def deserialize(self, f):
-        self.filter = deser_string(f)
+        self.filter = f.read_string()
         return self
 
     def serialize(self):
@@ -344,6 +363,7 @@ class msg_filterclear(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         return self
 
@@ -362,8 +382,9 @@ class msg_get_xblocktx(object):
         self.blockhash = blockhash
         self.setCheapHashesToRequest = qhashes
 
+    @reads_stream
     def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
+        self.blockhash = f.read_uint256()
         self.setCheapHashesToRequest = deser_vector(f, QHash)
         return self
 
@@ -387,13 +408,14 @@ class msg_req_xpedited(object):
     def __init__(self, options=None):
         self.options = options
 
+    @reads_stream
     def deserialize(self, f):
-        self.options = struct.unpack("<Q", f.read(8))[0]
+        self.options = f.read_u64()
         return self
 
     def serialize(self):
         r = b""
-        r += struct.pack("<Q", self.options)
+        r += struct_u64.pack(self.options)
         return r
 
     def __repr__(self):
@@ -4,7 +4,8 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 from .mininode import *
 from .blockstore import BlockStore, TxStore
-from .util import p2p_port
+from .util import p2p_port, NodeGroup
+from .authproxy import JSONRPCException
 import time
 '''
 This is a tool for comparing two or more bitcoinds to each other
@@ -157,15 +158,37 @@ class TestInstance(object):
         self.sync_every_block = sync_every_block
         self.sync_every_tx = sync_every_tx
 
+# Pipelining:
+#
+# TestManager(testgen, datadir, pipeline=N) lets up to N consecutive test
+# instances that only expect their blocks to be rejected (outcome False or a
+# RejectResult) be inv'ed without waiting for each other.  The batch is synced
+# once and then checked against the tip every node had before the batch (via
+# concurrent RPC) and against the reject maps, in test order, so the first
+# divergence is still reported with its own test number.  Any other test
+# instance first drains the batch and then runs exactly as before.  The test
+# generator must not depend on node state between such rejection tests.
+
+def in_active_chain(node, blockhash):
+    try:
+        return node.getblockheader('%064x' % blockhash)["confirmations"] > 0
+    except JSONRPCException:  # header was never accepted
+        return False
+
+# Seconds to wait for a node's RPC to catch up with an unexpected P2P tip;
+# block validation runs in its own thread so the two can briefly disagree.
+RPC_TIP_TIMEOUT = 20
+
 class TestManager(object):
 
-    def __init__(self, testgen, datadir):
+    def __init__(self, testgen, datadir, pipeline=0):
         self.test_generator = testgen
         self.connections    = []
         self.test_nodes     = []
         self.block_store    = BlockStore(datadir)
         self.tx_store       = TxStore(datadir)
         self.ping_counter   = 1
+        self.pipeline       = pipeline
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
@@ -191,6 +214,9 @@ class TestManager(object):
             return all(node.verack_received for node in self.test_nodes)
         return wait_until(veracked, timeout=10)
 
+    def rpc_group(self):
+        return NodeGroup(c.rpc for c in self.connections)
+
     def wait_for_pings(self, counter):
         def received_pongs():
             return all(node.received_ping_response(counter) for node in self.test_nodes)
@@ -200,13 +226,17 @@ class TestManager(object):
     # then send get_headers to find out the tip of each node, and synchronize
     # the response by using a ping (and waiting for pong with same nonce).
     def sync_blocks(self, blockhash, num_blocks):
+        self.sync_block_list([blockhash], num_blocks)
+
+    # As sync_blocks, but waits for every block in blockhashes to be requested
+    def sync_block_list(self, blockhashes, timeout):
         def blocks_requested():
             return all(
-                blockhash in node.block_request_map and node.block_request_map[blockhash]
-                for node in self.test_nodes
+                node.block_request_map.get(blockhash, False)
+                for node in self.test_nodes for blockhash in blockhashes
             )
         # --> error if not requested
-        if not wait_until(blocks_requested, attempts=20*num_blocks):
+        if not wait_until(blocks_requested, timeout=timeout):
             # print [ c.cb.block_request_map for c in self.connections ]
             raise AssertionError("Not all nodes requested block")
 
@@ -220,7 +250,7 @@ class TestManager(object):
 
     # Analogous to sync_block (see above)
     def sync_transaction(self, txhash, num_events):
-        # Wait for nodes to request transaction (50ms sleep * 20 tries * num_events)
+        # Wait for nodes to request transaction (up to a second per event)
         def transaction_requested():
             return all(
                 txhash in node.tx_request_map and node.tx_request_map[txhash]
@@ -228,7 +258,7 @@ class TestManager(object):
             )
 
         # --> error if not requested
-        if not wait_until(transaction_requested, attempts=20*num_events):
+        if not wait_until(transaction_requested, timeout=num_events):
             # print [ c.cb.tx_request_map for c in self.connections ]
             raise AssertionError("Not all nodes requested transaction")
 
@@ -247,6 +277,7 @@ class TestManager(object):
     # Verify that the tip of each connection all agree with each other, and
     # with the expected outcome (if given)
     def check_results(self, blockhash, outcome):
+        lagging = []
         with mininode_lock:
 
             for c in self.connections:
@@ -265,29 +296,30 @@ class TestManager(object):
                         return False
                 elif ((c.cb.bestblockhash == blockhash) != outcome):
                     print("Node ", c.addr, " has best block ", hex(c.cb.bestblockhash), ". Expecting ", hex(blockhash), outcome)
-                    hsh = c.rpc.getbestblockhash()
-                    print("Quick   RPC returns", hsh)
-                    t = 0
-                    # give 20 seconds to sync, this is a pretty generous number.  How much time might it take
-                    # an underpowered test node running 4-6 copies of bitcoind to sync them?  
-                    while t < 10 and hsh != hex(blockhash)[2:]:  # hex(blockhash) returns "0x..." whereas hsh does not have the "0x"
-                        t += 1
-                        time.sleep(2) 
-                        hsh = c.rpc.getbestblockhash()
-                    if t == 10:
-                        print("Delayed RPC returns", hsh)
-
-                    rpcblock =  c.rpc.getbestblockhash()
-                    block = hex(blockhash)[2:]
-                    #sometimes a leading zero or two are missing from the blockhash. Replace these.
-                    while (len(block) < 64):
-                        block = '0' + block
-                    if rpcblock == block:
-                        return True
-                    else:
-                        return False
-
-            return True
+                    lagging.append(c)
+
+        if lagging:
+            # The P2P view may lag behind validation, so ask the disagreeing
+            # nodes over RPC (all at once) before calling it a failure.
+            return self.wait_for_rpc_tips(lagging, blockhash, outcome)
+        return True
+
+    # Poll getbestblockhash on the given connections concurrently until
+    # (tip == blockhash) matches outcome on all of them or RPC_TIP_TIMEOUT
+    # seconds have passed.
+    def wait_for_rpc_tips(self, connections, blockhash, outcome):
+        block = '%064x' % blockhash
+        group = NodeGroup(c.rpc for c in connections)
+        deadline = time.time() + RPC_TIP_TIMEOUT
+        tips = group.getbestblockhash()
+        print("Quick   RPC returns", tips)
+        while any((tip == block) != outcome for tip in tips):
+            if time.time() >= deadline:
+                print("Delayed RPC returns", tips)
+                return False
+            time.sleep(0.5)
+            tips = group.getbestblockhash()
+        return True
 
     # Either check that the mempools all agree with each other, or that
     # txhash's presence in the mempool matches the outcome specified.
@@ -317,12 +349,101 @@ class TestManager(object):
                     return False
             return True
 
+    # Add a block to the shared block_store and reset its request state.
+    # If there was an open getdata request for the block previously, and we
+    # didn't have an entry in the block_store, then immediately deliver,
+    # because the node wouldn't send another getdata request while the
+    # earlier one is outstanding.
+    def add_block(self, block):
+        with mininode_lock:
+            first_block_with_hash = not self.block_store.contains(block.sha256)
+            self.block_store.add_block(block)
+            for c in self.connections:
+                if first_block_with_hash and c.cb.block_request_map.get(block.sha256) == True:
+                    # There was a previous request for this block hash
+                    # Most likely, we delivered a header for this block
+                    # but never had the block to respond to the getdata
+                    c.send_message(msg_block(block))
+                else:
+                    c.cb.block_request_map[block.sha256] = False
+
+    # Whether test_instance may join a pipelined batch: blocks only, each
+    # expected to be rejected and checked against its own hash.
+    def can_pipeline(self, test_instance):
+        objects = test_instance.blocks_and_transactions
+        if not self.pipeline or not objects:
+            return False
+        if not test_instance.sync_every_block and len(objects) > 1:
+            return False
+        for test_obj in objects:
+            if not isinstance(test_obj[0], CBlock):
+                return False
+            if test_obj[1] is not False and not isinstance(test_obj[1], RejectResult):
+                return False
+            if len(test_obj) >= 3 and test_obj[2] != test_obj[0].sha256:
+                return False
+        return True
+
+    # Sync a pipelined batch, a list of (test_number, [(blockhash, outcome)])
+    # whose blocks were all inv'ed, and check each test in order.  base_tips
+    # holds every node's getbestblockhash from before the batch.
+    def check_pipeline(self, batch, base_tips):
+        blockhashes = [ h for (n, checks) in batch for (h, outcome) in checks ]
+        self.sync_block_list(blockhashes, len(blockhashes))
+
+        failed = []
+        group = self.rpc_group()
+        tips = group.getbestblockhash()
+        for (node, c, tip, base) in zip(group, self.connections, tips, base_tips):
+            if tip == base:
+                continue
+            # Some block was accepted: blame the first one now in the active
+            # chain (getblockheader reports -1 confirmations otherwise).
+            print("Node ", c.addr, " has best block ", tip, ". Expecting ", base)
+            for (n, checks) in batch:
+                if any(in_active_chain(node, h) for (h, outcome) in checks):
+                    failed.append(n)
+                    break
+            else:
+                failed.append(batch[0][0])
+
+        for (n, checks) in batch:
+            for (blockhash, outcome) in checks:
+                if isinstance(outcome, RejectResult) and not self.check_results(blockhash, outcome):
+                    failed.append(n)
+        if failed:
+            raise AssertionError("Test failed at test %d" % min(failed))
+
+        counts = group.getblockcount()
+        for (n, checks) in batch:
+            print("Test %d: PASS" % n, counts)
+
     def run(self):
         # Wait until verack is received
         self.wait_for_verack()
 
         test_number = 1
+        batch = []
         for test_instance in self.test_generator.get_tests():
+            if self.can_pipeline(test_instance):
+                if not batch:
+                    base_tips = self.rpc_group().getbestblockhash()
+                checks = []
+                for test_obj in test_instance.blocks_and_transactions:
+                    self.add_block(test_obj[0])
+                    checks.append((test_obj[0].sha256, test_obj[1]))
+                invs = [ CInv(2, h) for (h, outcome) in checks ]
+                [ c.send_message(msg_inv(invs)) for c in self.connections ]
+                batch.append((test_number, checks))
+                if len(batch) >= self.pipeline:
+                    self.check_pipeline(batch, base_tips)
+                    batch = []
+                test_number += 1
+                continue
+            if batch:
+                self.check_pipeline(batch, base_tips)
+                batch = []
+
             # We use these variables to keep track of the last block
             # and last transaction in the tests, which are used
             # if we're not syncing on every block or every tx.
@@ -344,25 +465,7 @@ class TestManager(object):
                     if len(test_obj) >= 3:
                         tip = test_obj[2]
 
-                    # Add to shared block_store, set as current block
-                    # If there was an open getdata request for the block
-                    # previously, and we didn't have an entry in the
-                    # block_store, then immediately deliver, because the
-                    # node wouldn't send another getdata request while
-                    # the earlier one is outstanding.
-                    first_block_with_hash = True
-                    if self.block_store.get(block.sha256) is not None:
-                        first_block_with_hash = False
-                    with mininode_lock:
-                        self.block_store.add_block(block)
-                        for c in self.connections:
-                            if first_block_with_hash and block.sha256 in c.cb.block_request_map and c.cb.block_request_map[block.sha256] == True:
-                                # There was a previous request for this block hash
-                                # Most likely, we delivered a header for this block
-                                # but never had the block to respond to the getdata
-                                c.send_message(msg_block(block))
-                            else:
-                                c.cb.block_request_map[block.sha256] = False
+                    self.add_block(block)
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
                     if (test_instance.sync_every_block):
@@ -413,9 +516,12 @@ class TestManager(object):
                 if (not self.check_mempool(tx.sha256, tx_outcome)):
                     raise AssertionError("Mempool test failed at test %d" % test_number)
 
-            print("Test %d: PASS" % test_number, [ c.rpc.getblockcount() for c in self.connections ])
+            print("Test %d: PASS" % test_number, self.rpc_group().getblockcount())
             test_number += 1
 
+        if batch:
+            self.check_pipeline(batch, base_tips)
+
         [ c.disconnect_node() for c in self.connections ]
         self.wait_for_disconnections()
         self.block_store.close()
@@ -55,11 +55,60 @@ class AuthServiceProxyWrapper(object):
 
         return return_val
 
+    def batch(self, *args, **kwargs):
+        """
+        Return a batch (see AuthServiceProxy.batch) whose calls are written
+        to the coverage file once it has been sent.
+
+        """
+        return self.auth_service_proxy_instance.batch(
+            *args, on_execute=self._log_batch, **kwargs)
+
+    def _log_batch(self, rpc_methods):
+        if self.coverage_logfile:
+            with open(self.coverage_logfile, 'a+') as f:
+                f.writelines("%s\n" % m for m in rpc_methods)
+
     @property
     def url(self):
         return self.auth_service_proxy_instance.url
 
 
+class AsyncAuthServiceProxyWrapper(object):
+    """
+    The AsyncAuthServiceProxy counterpart of AuthServiceProxyWrapper; writes
+    to the same per-node coverage file once each call has completed.
+
+    """
+    def __init__(self, async_proxy_instance, coverage_logfile=None):
+        self.async_proxy_instance = async_proxy_instance
+        self.coverage_logfile = coverage_logfile
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+
+        async def rpc_call(*args):
+            return await self.call(name, *args)
+        return rpc_call
+
+    async def call(self, rpc_method, *args):
+        return_val = await self.async_proxy_instance.call(rpc_method, *args)
+
+        if self.coverage_logfile:
+            with open(self.coverage_logfile, 'a+') as f:
+                f.write("%s\n" % rpc_method)
+
+        return return_val
+
+    async def close(self):
+        await self.async_proxy_instance.close()
+
+    @property
+    def url(self):
+        return self.async_proxy_instance.url
+
+
 def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
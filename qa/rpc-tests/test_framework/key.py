@@ -75,6 +75,9 @@ ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
 # this specifies the curve used with ECDSA.
 NID_secp256k1 = 714 # from openssl/obj_mac.h
 
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+
 # Thx to Sam Devlin for the ctypes magic 64-bit fix.
 def _check_result(val, func, args):
     if val == 0:
@@ -147,7 +150,7 @@ class CECKey(object):
         r = self.get_raw_ecdh_key(other_pubkey)
         return kdf(r)
 
-    def sign(self, hash):
+    def sign(self, hash, low_s=False):
         # FIXME: need unit tests for below cases
         if not isinstance(hash, bytes):
             raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
@@ -159,7 +162,22 @@ class CECKey(object):
         mb_sig = ctypes.create_string_buffer(sig_size0.value)
         result = ssl.ECDSA_sign(0, hash, len(hash), mb_sig, ctypes.byref(sig_size0), self.k)
         assert 1 == result
-        return mb_sig.raw[:sig_size0.value]
+        sig = mb_sig.raw[:sig_size0.value]
+        if not low_s:
+            return sig
+        # Nodes only relay signatures with S in the lower half of the curve
+        # order (BIP62 LOW_S), so mirror S if OpenSSL picked the upper one.
+        # sig is DER: 0x30 len 0x02 rlen r 0x02 slen s
+        r_size = sig[3]
+        s_size = sig[5 + r_size]
+        s_value = int.from_bytes(sig[6 + r_size:6 + r_size + s_size], 'big')
+        if s_value <= SECP256K1_ORDER_HALF:
+            return sig
+        s_bytes = (SECP256K1_ORDER - s_value).to_bytes(33, 'big')
+        while len(s_bytes) > 1 and s_bytes[0] == 0 and s_bytes[1] < 0x80:
+            s_bytes = s_bytes[1:]
+        body = sig[2:5 + r_size] + bytes([len(s_bytes)]) + s_bytes
+        return bytes([0x30, len(body)]) + body
 
     def verify(self, hash, sig):
         """Verify a DER signature"""
@@ -24,7 +24,9 @@
 import pdb
 import struct
 import socket
-import asyncore
+import selectors
+import os
+import errno
 import time
 import sys
 import random
@@ -32,10 +34,12 @@ from binascii import hexlify, unhexlify
 from io import BytesIO
 from codecs import encode
 import hashlib
-from threading import RLock
+from threading import RLock, Lock
 from threading import Thread
 import logging
 import copy
+from collections import deque
+from itertools import islice
 
 from .nodemessages import *
 from .bumessages import *
@@ -45,12 +49,35 @@ BIP0031_VERSION = 60000
 MAX_INV_SZ = 50000
 MAX_BLOCK_SIZE = 1000000
 
+# NodeConn reads from its socket in chunks of between RECV_SIZE_MIN and
+# RECV_SIZE_MAX bytes, growing the chunk while the socket keeps filling it
+RECV_SIZE_MIN = 64 * 1024
+RECV_SIZE_MAX = 4 * 1024 * 1024
 
-# Keep our own socket map for asyncore, so that we can track disconnects
-# ourselves (to workaround an issue with closing an asyncore socket when
-# using select)
+# Maximum number of buffers handed to one sendmsg() call (IOV_MAX on Linux)
+SEND_IOV_MAX = 1024
+
+
+# Map of socket file descriptor to NodeConn for all open connections; the
+# NetworkThread runs as long as it is not empty
 mininode_socket_map = dict()
 
+# The NetworkThread blocks in select() until a socket is ready or another
+# thread writes to this socket pair, e.g. because it queued a message
+(_wakeup_reader, _wakeup_writer) = socket.socketpair()
+_wakeup_reader.setblocking(False)
+_wakeup_writer.setblocking(False)
+
+# Upper bound on how long the NetworkThread sleeps without being woken up
+SELECT_TIMEOUT = 1
+
+
+def wakeup_network_thread():
+    try:
+        _wakeup_writer.send(b"\x00")
+    except OSError:
+        pass   # buffer full: a wakeup is pending anyway
+
 # This is what a callback should look like for NodeConn
 # Reimplement the on_* functions to provide handling for events
 class NodeConnCB(object):
@@ -74,11 +101,7 @@ class NodeConnCB(object):
     # This can be called from the testing thread, so it needs to acquire the
     # global lock.
     def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
+        wait_until(lambda: self.verack_received)
 
     def deliver(self, conn, message):
         deliver_sleep = self.get_deliver_sleep_time()
@@ -157,6 +180,10 @@ class SingleNodeConnCB(NodeConnCB):
     def send_message(self, message):
         self.connection.send_message(message)
 
+    # Wrapper for the NodeConn's send_messages function
+    def send_messages(self, messages):
+        self.connection.send_messages(messages)
+
     def on_pong(self, conn, message):
         self.last_pong = message
 
@@ -175,6 +202,25 @@ def dupdate(x, y):
     return x
 
 
+class PreframedMessage(object):
+    """
+    A message whose payload and checksum are computed once, so that it
+    can be sent any number of times, over any connection, without being
+    serialized again.  The wrapped message must not change afterwards.
+    """
+    def __init__(self, message):
+        self.command = message.command
+        self.message = message
+        self.data = message.serialize()
+        self.checksum = sha256(sha256(self.data))[:4]
+
+    def serialize(self):
+        return self.data
+
+    def __repr__(self):
+        return "PreframedMessage(command=%s size=%d)" % (self.command.decode("ascii"), len(self.data))
+
+
 class MsgAnnotater:
     def __init__(self):
         self.idx = 0
@@ -189,7 +235,7 @@ class MsgAnnotater:
 # This class provides an interface for a p2p connection to a specified node
 
 
-class NodeConn(asyncore.dispatcher):
+class NodeConn(object):
     messagemap = dupdate({
         b"version": msg_version,
         b"verack": msg_verack,
@@ -217,13 +263,23 @@ class NodeConn(asyncore.dispatcher):
     }
 
     def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=1):
-        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
         self.log = logging.getLogger("NodeConn(%s:%d)" % (dstaddr, dstport))
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self._fileno = self.socket.fileno()
+        # frames waiting to be sent, each a bytes or memoryview; the first one
+        # may have been sent partially
+        self.sendbuf = deque()
+        # Lock order: mininode_lock before sendbuf_lock.  Callbacks run with
+        # mininode_lock held and send from there, so nothing may take
+        # mininode_lock while holding sendbuf_lock.
+        self.sendbuf_lock = Lock()
+        # unparsed received data; consumed from the front, which is cheap for
+        # a bytearray
+        self.recvbuf = bytearray()
+        self.recv_size = RECV_SIZE_MIN
         self.ver_send = 209
         self.ver_recv = 209
         self.last_sent = 0
@@ -242,11 +298,17 @@ class NodeConn(asyncore.dispatcher):
         self.send_message(vt, True)
         print('MiniNode: Connecting to Bitcoin Node IP # ' + dstaddr + ':'
               + str(dstport))
+        mininode_socket_map[self._fileno] = self
         try:
-            self.connect((dstaddr, dstport))
+            err = self.socket.connect_ex((dstaddr, dstport))
+            if err == 0:
+                self.handle_connect()
+            elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(err, os.strerror(err))
         except:
             self.handle_close()
         self.rpc = rpc
+        wakeup_network_thread()
 
     def show_debug_msg(self, msg):
         self.log.debug(msg)
@@ -254,21 +316,51 @@ class NodeConn(asyncore.dispatcher):
     def handle_connect(self):
         self.show_debug_msg("MiniNode: Connected & Listening: \n")
         self.state = "connected"
+        notify_waiters()
+
+    def handle_connect_event(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.show_debug_msg("MiniNode: Connection to %s:%d failed: %s"
+                                % (self.dstaddr, self.dstport, os.strerror(err)))
+            self.handle_close()
+        else:
+            self.handle_connect()
+
+    def handle_read_event(self):
+        if self.state == "connecting":
+            self.handle_connect_event()
+        if self.state != "closed":
+            self.handle_read()
+
+    def handle_write_event(self):
+        if self.state == "connecting":
+            self.handle_connect_event()
+        if self.state != "closed" and self.writable():
+            self.handle_write()
+
+    def close(self):
+        if mininode_socket_map.get(self._fileno) is self:
+            del mininode_socket_map[self._fileno]
+        self.socket.close()
+        wakeup_network_thread()
 
     def handle_close(self):
         self.show_debug_msg("MiniNode: Closing Connection to %s:%d... "
                             % (self.dstaddr, self.dstport))
         self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
+        self.recvbuf = bytearray()
+        with self.sendbuf_lock:
+            self.sendbuf = deque()
         try:
             self.close()
         except:
             pass
         self.cb.on_close(self)
+        notify_waiters()
 
     def parse_messages(self, buffer):
-        if not type(buffer) == type(b""):  # if not a buffer its a file
+        if not isinstance(buffer, (bytes, bytearray, memoryview)):  # if not a buffer its a file
             buffer = buffer.read()
         tmp = self.cb
         ret = []
@@ -284,99 +376,141 @@ class NodeConn(asyncore.dispatcher):
 
     def handle_read(self):
         try:
-            t = self.recv(8192)
-            if len(t) > 0:
-                self.recvbuf += t
-                self.got_data()
-        except:
-            pass
+            t = self.socket.recv(self.recv_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.handle_close()
+            return
+        if len(t) == 0:
+            self.handle_close()
+            return
+        if len(t) == self.recv_size:
+            self.recv_size = min(2 * self.recv_size, RECV_SIZE_MAX)
+        elif len(t) < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, RECV_SIZE_MIN)
+        self.recvbuf += t
+        self.got_data()
 
     def readable(self):
         return True
 
     def writable(self):
-        with mininode_lock:
+        with self.sendbuf_lock:
             length = len(self.sendbuf)
         return (length > 0)
 
     def handle_write(self):
-        with mininode_lock:
+        # handle_close() takes mininode_lock, which must never be acquired
+        # while holding sendbuf_lock (see there), so only note the failure
+        # here and close once the send buffer is released.
+        failed = False
+        with self.sendbuf_lock:
+            bufs = list(islice(self.sendbuf, SEND_IOV_MAX))
             try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
+                if hasattr(self.socket, "sendmsg"):
+                    sent = self.socket.sendmsg(bufs)
+                else:
+                    sent = self.socket.send(bufs[0])
+            except BlockingIOError:
                 return
-            self.sendbuf = self.sendbuf[sent:]
+            except:
+                failed = True
+                sent = 0
+            # drop what was sent without copying the rest
+            while self.sendbuf:
+                head = self.sendbuf[0]
+                if sent < len(head):
+                    if sent:
+                        self.sendbuf[0] = memoryview(head)[sent:]
+                    break
+                sent -= len(head)
+                self.sendbuf.popleft()
+        if failed:
+            self.handle_close()
 
     def got_data(self):
-        self.recvBufLen = len(self.recvbuf)
+        """
+        Parse and deliver all complete messages in recvbuf.
+
+        Headers and checksums are read through a memoryview, so the only copy
+        made of a message is its payload, once, for deserialization.
+        """
+        buf = self.recvbuf
+        pos = 0
         try:
-            while True:
-                nowLen = len(self.recvbuf)
-                self.curIndex += (self.recvBufLen - nowLen)
-                self.recvBufLen = nowLen
-                if nowLen < 4:
-                    return
-                if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
-                if self.ver_recv < 209:
-                    if len(self.recvbuf) < 4 + 12 + 4:
+            with memoryview(buf) as view:
+                while True:
+                    if len(buf) - pos < 4:
                         return
-                    command = self.recvbuf[4:4 + 12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4 + 12:4 + 12 + 4])[0]
-                    checksum = None
-                    if len(self.recvbuf) < 4 + 12 + 4 + msglen:
+                    if view[pos:pos + 4] != self.MAGIC_BYTES[self.network]:
+                        raise ValueError("got garbage %s" % repr(bytes(view[pos:])))
+                    if self.ver_recv < 209:
+                        hdrlen = 4 + 12 + 4
+                    else:
+                        hdrlen = 4 + 12 + 4 + 4
+                    if len(buf) - pos < hdrlen:
                         return
-                    msg = self.recvbuf[4 + 12 + 4:4 + 12 + 4 + msglen]
-                    self.recvbuf = self.recvbuf[4 + 12 + 4 + msglen:]
-                else:
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                    command = bytes(view[pos + 4:pos + 4 + 12]).split(b"\x00", 1)[0]
+                    msglen = struct.unpack_from("<i", view, pos + 4 + 12)[0]
+                    end = pos + hdrlen + msglen
+                    if len(buf) < end:
                         return
-                    command = self.recvbuf[4:4 + 12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4 + 12:4 + 12 + 4])[0]
-                    checksum = self.recvbuf[4 + 12 + 4:4 + 12 + 4 + 4]
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4 + 12 + 4 + 4:4 + 12 + 4 + 4 + msglen]
-                    th = sha256(msg)
-                    h = sha256(th)
-                    if checksum != h[:4]:
-                        raise ValueError("got bad checksum " + repr(self.recvbuf))
-                    self.recvbuf = self.recvbuf[4 + 12 + 4 + 4 + msglen:]
-                if command in self.messagemap:
-                    f = BytesIO(msg)
-                    t = self.messagemap[command]()
-                    t.deserialize(f)
-                    self.got_message(t)
-                else:
-                    print("Unknown command: '" + str(command) + "' ")
-                    self.show_debug_msg("Unknown command: '" + str(command) + "' " +
-                                        repr(msg))
-                    # pdb.set_trace()
+                    with view[pos + hdrlen:end] as payload:
+                        if self.ver_recv >= 209:
+                            h = sha256(sha256(payload))
+                            if view[pos + 4 + 12 + 4:pos + hdrlen] != h[:4]:
+                                raise ValueError("got bad checksum " + repr(bytes(view[pos:end])))
+                        msg = payload.tobytes()
+                    pos = end
+                    if command in self.messagemap:
+                        f = ByteReader(msg)
+                        t = self.messagemap[command]()
+                        t.deserialize(f)
+                        self.got_message(t)
+                    else:
+                        print("Unknown command: '" + str(command) + "' ")
+                        self.show_debug_msg("Unknown command: '" + str(command) + "' " +
+                                            repr(msg))
+                        # pdb.set_trace()
+                    self.curIndex += hdrlen + msglen
         except Exception as e:
             print('got_data:', repr(e))
             #import traceback
             #traceback.print_tb(sys.exc_info()[2])
             #pdb.post_mortem(e.__traceback__)
+        finally:
+            # handle_close() may have replaced the buffer while delivering
+            if pos and self.recvbuf is buf:
+                del buf[:pos]
 
-    def send_message(self, message, pushbuf=False):
-        if self.state != "connected" and not pushbuf:
-            return
-        self.show_debug_msg("Send %s" % repr(message))
+    def frame_message(self, message):
+        """Return the header and payload buffers that make up the wire format of message"""
         command = message.command
         data = message.serialize()
-        tmsg = self.MAGIC_BYTES[self.network]
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
         if self.ver_send >= 209:
-            th = sha256(data)
-            h = sha256(th)
-            tmsg += h[:4]
-        tmsg += data
-        with mininode_lock:
-            self.sendbuf += tmsg
+            checksum = getattr(message, "checksum", None) or sha256(sha256(data))[:4]
+        else:
+            checksum = b""
+        header = b"".join((self.MAGIC_BYTES[self.network], command, b"\x00" * (12 - len(command)),
+                           struct.pack("<I", len(data)), checksum))
+        return (header, data)
+
+    def send_message(self, message, pushbuf=False):
+        self.send_messages([message], pushbuf)
+
+    def send_messages(self, messages, pushbuf=False):
+        """Queue several messages at once; they are written with as few system calls as possible"""
+        if self.state != "connected" and not pushbuf:
+            return
+        frames = []
+        for message in messages:
+            self.show_debug_msg("Send %s" % repr(message))
+            frames.extend(self.frame_message(message))
+        with self.sendbuf_lock:
+            self.sendbuf.extend(frames)
             self.last_sent = time.time()
+        wakeup_network_thread()
 
     def got_message(self, message):
         if message.command == b"version":
@@ -386,23 +520,66 @@ class NodeConn(asyncore.dispatcher):
             self.send_message(self.messagemap[b'ping']())
         self.show_debug_msg("Recv %s" % repr(message))
         self.cb.deliver(self, message)
+        notify_waiters()
 
     def disconnect_node(self):
         self.disconnect = True
+        wakeup_network_thread()
 
 
 class NetworkThread(Thread):
+    """
+    Runs the i/o of all NodeConns until every connection is closed.
+
+    Sockets are watched with a selector; the thread sleeps until one of
+    them is ready or another thread calls wakeup_network_thread(), which
+    NodeConn does when a message is queued or a disconnect is requested.
+    """
     def run(self):
-        while mininode_socket_map:
-            # We check for whether to disconnect outside of the asyncore
-            # loop to workaround the behavior of asyncore when using
-            # select
-            disconnected = []
-            for fd, obj in mininode_socket_map.items():
-                if obj.disconnect:
-                    disconnected.append(obj)
-            [obj.handle_close() for obj in disconnected]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+        selector = selectors.DefaultSelector()
+        selector.register(_wakeup_reader, selectors.EVENT_READ)
+        try:
+            while mininode_socket_map:
+                for obj in list(mininode_socket_map.values()):
+                    if obj.disconnect:
+                        obj.handle_close()
+                self.update_selector(selector)
+                for (key, mask) in selector.select(SELECT_TIMEOUT):
+                    if key.fileobj is _wakeup_reader:
+                        self.drain_wakeups()
+                        continue
+                    obj = key.data
+                    if mask & selectors.EVENT_READ:
+                        obj.handle_read_event()
+                    if mask & selectors.EVENT_WRITE:
+                        obj.handle_write_event()
+        finally:
+            selector.close()
+
+    @staticmethod
+    def update_selector(selector):
+        """Make the selector watch exactly the open connections, for the events they are waiting for"""
+        conns = dict((obj.socket, obj) for obj in list(mininode_socket_map.values()))
+        for key in list(selector.get_map().values()):
+            if key.fileobj is not _wakeup_reader and key.fileobj not in conns:
+                selector.unregister(key.fileobj)
+        for (sock, obj) in conns.items():
+            events = selectors.EVENT_READ
+            if obj.state == "connecting" or obj.writable():
+                events |= selectors.EVENT_WRITE
+            key = selector.get_map().get(sock)
+            if key is None:
+                selector.register(sock, events, obj)
+            elif key.events != events:
+                selector.modify(sock, events, obj)
+
+    @staticmethod
+    def drain_wakeups():
+        try:
+            while _wakeup_reader.recv(4096):
+                pass
+        except OSError:
+            pass
 
 
 # An exception we can raise if we detect a potential disconnect
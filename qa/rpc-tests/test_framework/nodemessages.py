@@ -2,11 +2,18 @@ import socket
 import struct
 import random
 import hashlib
+import copy
+import functools
+import io
+import mmap
+import os
 from binascii import hexlify, unhexlify
 import time
 from codecs import encode
-from threading import RLock
+from threading import RLock, Condition
 from io import BytesIO
+from collections.abc import MutableSequence
+from concurrent.futures import ProcessPoolExecutor
 
 MY_VERSION = 60001  # past bip-31 for ping/pong
 MY_SUBVERSION = b"/python-mininode-tester:0.0.3/"
@@ -15,28 +22,41 @@ COIN = 100000000  # 1 btc in satoshis
 
 # One lock for synchronizing all data access between the networking thread (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
-# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the NodeConnCB or NodeConn.
+# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB.
+# This lock should be acquired in the thread running the test logic to
+# synchronize access to any data shared with the NodeConnCB or NodeConn.
+# (Send buffers have their own lock per NodeConn, always taken after this one.)
 mininode_lock = RLock()
 
-# Helper function
+# Notified by NodeConn every time it delivered a message or its connection
+# state changed, so waiters can re-check their condition right away.
+mininode_cond = Condition(mininode_lock)
 
+# wait_until re-checks its predicate at least this often even without a
+# notification, for predicates that depend on more than p2p messages
+WAIT_UNTIL_RECHECK = 0.05
 
-def wait_until(predicate, attempts=float('inf'), timeout=float('inf')):
-    attempt = 0
-    elapsed = 0
 
-    while attempt < attempts and elapsed < timeout:
-        with mininode_lock:
-            if predicate():
-                return True
-        attempt += 1
-        elapsed += 0.05
-        time.sleep(0.05)
+def notify_waiters():
+    with mininode_lock:
+        mininode_cond.notify_all()
+
 
-    return False
+def wait_until(predicate, attempts=float('inf'), timeout=float('inf')):
+    """
+    Wait until predicate(), called with mininode_lock held, returns true.
+    Returns False if that did not happen within timeout seconds or, as
+    with the former polling loop, within attempts * WAIT_UNTIL_RECHECK
+    seconds.
+    """
+    deadline = time.time() + min(timeout, attempts * WAIT_UNTIL_RECHECK)
+    with mininode_lock:
+        while not predicate():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            mininode_cond.wait(min(remaining, WAIT_UNTIL_RECHECK))
+    return True
 
 
 # Serialization/deserialization tools
@@ -58,21 +78,275 @@ def hash256(s):
     return sha256(sha256(s))
 
 
+# Precompiled codecs for the fixed size integers of the wire format
+struct_u8 = struct.Struct("<B")
+struct_u16 = struct.Struct("<H")
+struct_i32 = struct.Struct("<i")
+struct_u32 = struct.Struct("<I")
+struct_i64 = struct.Struct("<q")
+struct_u64 = struct.Struct("<Q")
+# nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce
+struct_block_header = struct.Struct("<i32s32sIII")
+struct_port = struct.Struct(">H")
+struct_outpoint = struct.Struct("<32sI")
+
+UINT256_MASK = (1 << 256) - 1
+
+
+def ser_compact_size(n):
+    """Serialize a length/count in bitcoin's variable length CompactSize format
+
+    >>> [hexlify(ser_compact_size(n)) for n in (252, 253, 0x10000, 0x100000000)]
+    [b'fc', b'fdfd00', b'fe00000100', b'ff0000000001000000']
+    """
+    if n < 253:
+        return struct_u8.pack(n)
+    elif n < 0x10000:
+        return b"\xfd" + struct_u16.pack(n)
+    elif n < 0x100000000:
+        return b"\xfe" + struct_u32.pack(n)
+    return b"\xff" + struct_u64.pack(n)
+
+
+class ByteReader(object):
+    """
+    Reads the bitcoin wire format from a buffer: bytes, a bytearray, a
+    memoryview or a mmap of a file.  Every deserialize(f) reads through
+    one of these.  read_view() returns slices of the underlying buffer
+    without copying (except from a BytesIO's buffer, see from_stream());
+    the other methods return new objects.
+
+    >>> f = ByteReader(unhexlify("01000000fd0301" + "ab" * 32) + ser_string(b"xyz"))
+    >>> (f.read_u32(), f.read_compact_size(), hex(f.read_uint256())[:6], f.read_string())
+    (1, 259, '0xabab', b'xyz')
+    >>> f.read_string()
+    Traceback (most recent call last):
+        ...
+    IndexError: index out of bounds on dimension 1
+    """
+    __slots__ = ("buf", "pos", "end", "stream", "start", "borrowed")
+
+    def __init__(self, data, pos=0):
+        self.buf = memoryview(data)
+        self.pos = pos
+        self.end = len(self.buf)
+        self.stream = None  # the stream to move past what was read, see from_stream()
+        self.start = 0
+        self.borrowed = False  # buf is the stream's own buffer, see release()
+
+    @classmethod
+    def from_stream(cls, f):
+        """
+        A reader for the rest of file-like object f.  Call sync() when done
+        to move f past what was read, and release() to let go of f.  A
+        BytesIO is read in place and a regular file is mapped into memory,
+        other streams are read in full.
+        """
+        start = f.tell()
+        if hasattr(f, "getbuffer"):
+            reader = cls(f.getbuffer(), start)
+            reader.borrowed = True
+        else:
+            try:
+                reader = cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), start)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                reader = cls(f.read())
+                reader.start = start
+        reader.stream = f
+        return reader
+
+    @classmethod
+    def open(cls, filename):
+        """A reader over the memory-mapped contents of file 'filename'"""
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b"")
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def sync(self):
+        if self.stream is not None:
+            self.stream.seek(self.start + self.pos)
+
+    def release(self):
+        """
+        Drop the view of a BytesIO's buffer, which otherwise keeps the
+        BytesIO from being written past its end or closed
+        """
+        if self.borrowed:
+            self.buf.release()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, n=-1):
+        """Like BytesIO.read(): at most n bytes, all remaining ones if n < 0"""
+        p = self.pos
+        e = self.end if n < 0 else min(p + n, self.end)
+        self.pos = e
+        return self.buf[p:e].tobytes()
+
+    def read_view(self, n):
+        """
+        The next n bytes as a memoryview of the buffer, or of a copy of
+        them if the buffer is borrowed from a stream
+        """
+        p = self.pos
+        e = p + n
+        if e > self.end:
+            raise ValueError("read of %d bytes at offset %d is past the end of the data" % (n, p))
+        self.pos = e
+        if self.borrowed:
+            return memoryview(self.buf[p:e].tobytes())
+        return self.buf[p:e]
+
+    def read_bytes(self, n):
+        p = self.pos
+        e = p + n
+        if e > self.end:
+            raise ValueError("read of %d bytes at offset %d is past the end of the data" % (n, p))
+        self.pos = e
+        return self.buf[p:e].tobytes()
+
+    def read_string(self):
+        """A compact size length followed by that many bytes"""
+        p = self.pos
+        n = self.buf[p]
+        if n < 253:
+            p += 1
+        else:
+            (n, p) = skip_compact_size(self.buf, p)
+        e = p + n
+        if e > self.end:
+            raise ValueError("read of %d bytes at offset %d is past the end of the data" % (n, p))
+        self.pos = e
+        return self.buf[p:e].tobytes()
+
+    def read_struct(self, s):
+        """Unpack the precompiled struct.Struct s"""
+        p = self.pos
+        self.pos = p + s.size
+        return s.unpack_from(self.buf, p)
+
+    def read_u8(self):
+        p = self.pos
+        self.pos = p + 1
+        return struct_u8.unpack_from(self.buf, p)[0]
+
+    def read_u16(self):
+        p = self.pos
+        self.pos = p + 2
+        return struct_u16.unpack_from(self.buf, p)[0]
+
+    def read_i32(self):
+        p = self.pos
+        self.pos = p + 4
+        return struct_i32.unpack_from(self.buf, p)[0]
+
+    def read_u32(self):
+        p = self.pos
+        self.pos = p + 4
+        return struct_u32.unpack_from(self.buf, p)[0]
+
+    def read_i64(self):
+        p = self.pos
+        self.pos = p + 8
+        return struct_i64.unpack_from(self.buf, p)[0]
+
+    def read_u64(self):
+        p = self.pos
+        self.pos = p + 8
+        return struct_u64.unpack_from(self.buf, p)[0]
+
+    def read_uint256(self):
+        p = self.pos
+        e = p + 32
+        if e > self.end:
+            raise ValueError("read of 32 bytes at offset %d is past the end of the data" % p)
+        self.pos = e
+        return int.from_bytes(self.buf[p:e], "little")
+
+    def read_compact_size(self):
+        p = self.pos
+        n = self.buf[p]
+        if n < 253:
+            self.pos = p + 1
+            return n
+        (n, self.pos) = skip_compact_size(self.buf, p)
+        return n
+
+
+def reads_stream(deserialize):
+    """
+    Decorator for deserialize(self, f) methods, which read from a
+    ByteReader, so that they also take any binary stream such as a
+    BytesIO.  The stream is left just after the data that was read.
+    """
+    @functools.wraps(deserialize)
+    def wrapper(self, f):
+        if isinstance(f, ByteReader):
+            return deserialize(self, f)
+        reader = ByteReader.from_stream(f)
+        try:
+            return deserialize(self, reader)
+        finally:
+            reader.sync()
+            reader.release()
+    return wrapper
+
+
+def deser_reads_stream(deser):
+    """reads_stream for the deser_*(f, ...) functions"""
+    @functools.wraps(deser)
+    def wrapper(f, *args):
+        if isinstance(f, ByteReader):
+            return deser(f, *args)
+        reader = ByteReader.from_stream(f)
+        try:
+            return deser(reader, *args)
+        finally:
+            reader.sync()
+            reader.release()
+    return wrapper
+
+
+def skip_compact_size(buf, pos):
+    """Return (value, position after it) of the compact size at buf[pos]"""
+    n = buf[pos]
+    if n < 253:
+        return (n, pos + 1)
+    elif n == 253:
+        return (struct_u16.unpack_from(buf, pos + 1)[0], pos + 3)
+    elif n == 254:
+        return (struct_u32.unpack_from(buf, pos + 1)[0], pos + 5)
+    return (struct_u64.unpack_from(buf, pos + 1)[0], pos + 9)
+
+
+@deser_reads_stream
+def deser_compact_size(f):
+    """
+    >>> [deser_compact_size(ByteReader(ser_compact_size(n))) for n in (252, 253, 0x10000, 0x100000000)]
+    [252, 253, 65536, 4294967296]
+    >>> f = io.BytesIO(ser_compact_size(0x10000) + b"x")
+    >>> (deser_compact_size(f), f.read())
+    (65536, b'x')
+    """
+    return f.read_compact_size()
+
+
+@deser_reads_stream
 def deser_string(f):
     """Convert an array of bytes in the bitcoin P2P protocol format into a string
 
-    >>> import io
-    >>> deser_string(io.BytesIO(ser_string("The grid bug bites!  You get zapped!".encode()))).decode()
+    >>> deser_string(ByteReader(ser_string("The grid bug bites!  You get zapped!".encode()))).decode()
     'The grid bug bites!  You get zapped!'
+    >>> f = io.BytesIO(ser_string(b"xyz") + b"!")
+    >>> (deser_string(f), f.read())
+    (b'xyz', b'!')
     """
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return f.read(nit)
+    return f.read_string()
 
 
 def ser_string(s):
@@ -81,37 +355,33 @@ def ser_string(s):
        >>> ser_string("The grid bug bites!  You get zapped!".encode())
        b'$The grid bug bites!  You get zapped!'
     """
-    if len(s) < 253:
-        return struct.pack("B", len(s)) + s
-    elif len(s) < 0x10000:
-        return struct.pack("<BH", 253, len(s)) + s
-    elif len(s) < 0x100000000:
-        return struct.pack("<BI", 254, len(s)) + s
-    return struct.pack("<BQ", 255, len(s)) + s
+    return ser_compact_size(len(s)) + s
 
 
+@deser_reads_stream
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    """
+    >>> f = io.BytesIO(ser_uint256(0x0102) + b"!")
+    >>> (hex(deser_uint256(f)), f.read())
+    ('0x102', b'!')
+    >>> deser_uint256(io.BytesIO(b'\\x01' * 31))
+    Traceback (most recent call last):
+      ...
+    ValueError: read of 32 bytes at offset 0 is past the end of the data
+    """
+    return f.read_uint256()
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    """
+    >>> hexlify(ser_uint256(0x0102))
+    b'0201000000000000000000000000000000000000000000000000000000000000'
+    """
+    return (u & UINT256_MASK).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], "little")
 
 
 def uint256_from_compact(c):
@@ -120,131 +390,80 @@ def uint256_from_compact(c):
     return v
 
 
+@deser_reads_stream
 def deser_vector(f, c):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+    """
+    Objects are created as they are read, so a bogus count fails on the
+    data running out rather than by allocating count objects up front
+
+    >>> deser_vector(ByteReader(ser_compact_size(2**40) + b'\\x00' * 40), CInv)
+    Traceback (most recent call last):
+      ...
+    ValueError: read of 32 bytes at offset 49 is past the end of the data
+    >>> f = io.BytesIO(ser_vector([CInv(1, 5), CInv(2, 6)]) + b"!")
+    >>> ([(i.type, i.hash) for i in deser_vector(f, CInv)], f.read())
+    ([(1, 5), (2, 6)], b'!')
+    """
+    # f is a ByteReader already, skip the reads_stream wrapper
+    deserialize = getattr(c.deserialize, "__wrapped__", c.deserialize)
     r = []
-    for i in range(nit):
+    for i in range(f.read_compact_size()):
         t = c()
-        t.deserialize(f)
+        deserialize(t, f)
         r.append(t)
     return r
 
 
 def ser_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
-    for i in l:
-        r += i.serialize()
-    return r
+    return ser_compact_size(len(l)) + b"".join([i.serialize() for i in l])
 
 
+@deser_reads_stream
 def deser_uint256_vector(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    r = []
-    for i in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    """
+    >>> f = io.BytesIO(ser_uint256_vector([1, 2]) + b"!")
+    >>> (deser_uint256_vector(f), f.read())
+    ([1, 2], b'!')
+    """
+    return [f.read_uint256() for i in range(f.read_compact_size())]
 
 
 def ser_uint256_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return ser_compact_size(len(l)) + b"".join([ser_uint256(i) for i in l])
 
 
+@deser_reads_stream
 def deser_string_vector(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    r = []
-    for i in range(nit):
-        t = deser_string(f)
-        r.append(t)
-    return r
+    """
+    >>> f = io.BytesIO(ser_string_vector([b"a", b"bc"]) + b"!")
+    >>> (deser_string_vector(f), f.read())
+    ([b'a', b'bc'], b'!')
+    """
+    return [f.read_string() for i in range(f.read_compact_size())]
 
 
 def ser_string_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    return ser_compact_size(len(l)) + b"".join([ser_string(sv) for sv in l])
 
 
+@deser_reads_stream
 def deser_int_vector(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    r = []
-    for i in range(nit):
-        t = struct.unpack("<i", f.read(4))[0]
-        r.append(t)
-    return r
+    """
+    >>> f = io.BytesIO(ser_int_vector([1, -2]) + b"!")
+    >>> (deser_int_vector(f), f.read())
+    ([1, -2], b'!')
+    """
+    return [f.read_i32() for i in range(f.read_compact_size())]
 
 
 def ser_int_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
-    for i in l:
-        r += struct.pack("<i", i)
-    return r
+    return ser_compact_size(len(l)) + b"".join([struct_i32.pack(i) for i in l])
 
 # Deserialize from a hex string representation (eg from RPC)
 
 
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(unhexlify(hex_string.encode('ascii'))))
+    obj.deserialize(ByteReader(unhexlify(hex_string.encode('ascii'))))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
@@ -256,6 +475,29 @@ def ToHex(obj):
 
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
+# Pickle support for the classes below that use __slots__ to save memory;
+# also covers subclasses that add a __dict__
+def slots_getstate(self):
+    """
+    >>> import pickle
+    >>> tx = CTransaction()
+    >>> tx.vout.append(CTxOut(5, b"x"))
+    >>> [pickle.loads(pickle.dumps(tx, p)).vout for p in (0, pickle.HIGHEST_PROTOCOL)]
+    [[CTxOut(nValue=0.00000005 scriptPubKey=b'78')], [CTxOut(nValue=0.00000005 scriptPubKey=b'78')]]
+    """
+    state = dict(getattr(self, "__dict__", {}))
+    for cls in type(self).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+    return state
+
+
+def slots_setstate(self, state):
+    for (name, value) in state.items():
+        setattr(self, name, value)
+
+
 class CAddress(object):
     def __init__(self):
         self.nServices = 1
@@ -263,18 +505,19 @@ class CAddress(object):
         self.ip = "0.0.0.0"
         self.port = 0
 
+    @reads_stream
     def deserialize(self, f):
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.pchReserved = f.read(12)
-        self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.nServices = f.read_u64()
+        self.pchReserved = f.read_bytes(12)
+        self.ip = socket.inet_ntoa(f.read_bytes(4))
+        self.port = f.read_struct(struct_port)[0]
 
     def serialize(self):
         r = b""
-        r += struct.pack("<Q", self.nServices)
+        r += struct_u64.pack(self.nServices)
         r += self.pchReserved
         r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
+        r += struct_port.pack(self.port)
         return r
 
     def __repr__(self):
@@ -296,18 +539,22 @@ class CInv(object):
         4: "ThinBlock",
         5: "XThinBlock",
     }
+    __slots__ = ("type", "hash")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
 
     def __init__(self, t=0, h=0):
         self.type = t
         self.hash = h
 
+    @reads_stream
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
-        self.hash = deser_uint256(f)
+        self.type = f.read_i32()
+        self.hash = f.read_uint256()
 
     def serialize(self):
         r = b""
-        r += struct.pack("<i", self.type)
+        r += struct_i32.pack(self.type)
         r += ser_uint256(self.hash)
         return r
 
@@ -321,13 +568,14 @@ class CBlockLocator(object):
         self.nVersion = MY_VERSION
         self.vHave = []
 
+    @reads_stream
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = f.read_i32()
         self.vHave = deser_uint256_vector(f)
 
     def serialize(self):
         r = b""
-        r += struct.pack("<i", self.nVersion)
+        r += struct_i32.pack(self.nVersion)
         r += ser_uint256_vector(self.vHave)
         return r
 
@@ -337,25 +585,31 @@ class CBlockLocator(object):
 
 
 class COutPoint(object):
+    __slots__ = ("hash", "n")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
+
     def __init__(self, hash=0, n=0):
         self.hash = hash
         self.n = n
 
+    @reads_stream
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        self.hash = f.read_uint256()
+        self.n = f.read_u32()
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return ser_uint256(self.hash) + struct_u32.pack(self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
 class CTxIn(object):
+    __slots__ = ("prevout", "scriptSig", "nSequence")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
+
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
             self.prevout = COutPoint()
@@ -364,18 +618,15 @@ class CTxIn(object):
         self.scriptSig = scriptSig
         self.nSequence = nSequence
 
+    @reads_stream
     def deserialize(self, f):
-        self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        (h, n) = f.read_struct(struct_outpoint)
+        self.prevout = COutPoint(int.from_bytes(h, "little"), n)
+        self.scriptSig = f.read_string()
+        self.nSequence = f.read_u32()
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        return self.prevout.serialize() + ser_string(self.scriptSig) + struct_u32.pack(self.nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -384,19 +635,21 @@ class CTxIn(object):
 
 
 class CTxOut(object):
+    __slots__ = ("nValue", "scriptPubKey")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
+
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
+    @reads_stream
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
+        self.nValue = f.read_i64()
+        self.scriptPubKey = f.read_string()
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", int(self.nValue))
-        r += ser_string(self.scriptPubKey)
-        return r
+        return struct_i64.pack(int(self.nValue)) + ser_string(self.scriptPubKey)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -405,6 +658,30 @@ class CTxOut(object):
 
 
 class CTransaction(object):
+    """
+    Call rehash() after changing a transaction: sha256 and hash are cached,
+    and so is the serialization they were computed from, which
+    serialize_cached() (and so CBlock.serialize()) returns until sha256 is
+    reset.  serialize() always reflects the current fields.
+
+    >>> tx = CTransaction()
+    >>> tx.vout.append(CTxOut(1, b"a"))
+    >>> tx.rehash()
+    >>> tx.vout[0].nValue = 2
+    >>> tx.serialize_cached() == tx.serialize()
+    False
+    >>> tx.rehash()
+    >>> tx.serialize_cached() == tx.serialize()
+    True
+    """
+    __slots__ = ("nVersion", "vin", "vout", "nLockTime", "sha256", "hash", "_hashed")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
+
+    # How often a transaction got a different hash on being hashed again,
+    # which tells blocks that their merkle trees may be out of date
+    hash_changes = 0
+
     def __init__(self, tx=None):
         if tx is None:
             self.nVersion = 1
@@ -413,6 +690,7 @@ class CTransaction(object):
             self.nLockTime = 0
             self.sha256 = None
             self.hash = None
+            self._hashed = None
         else:
             self.nVersion = tx.nVersion
             self.vin = copy.deepcopy(tx.vin)
@@ -420,22 +698,21 @@ class CTransaction(object):
             self.nLockTime = tx.nLockTime
             self.sha256 = None
             self.hash = None
+            self._hashed = None
 
+    @reads_stream
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = f.read_i32()
         self.vin = deser_vector(f, CTxIn)
         self.vout = deser_vector(f, CTxOut)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = f.read_u32()
         self.sha256 = None
         self.hash = None
+        self._hashed = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return b"".join((struct_i32.pack(self.nVersion), ser_vector(self.vin), ser_vector(self.vout),
+                         struct_u32.pack(self.nLockTime)))
 
     def rehash(self):
         self.sha256 = None
@@ -443,8 +720,21 @@ class CTransaction(object):
 
     def calc_sha256(self):
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize()))
-        self.hash = encode(hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+            data = self.serialize()
+            h = hash256(data)
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+            if self._hashed is not None and self._hashed[0] != self.sha256:
+                CTransaction.hash_changes += 1
+            self._hashed = (self.sha256, data)
+        elif self.hash is None:
+            self.hash = "%064x" % self.sha256
+
+    def serialize_cached(self):
+        """The serialization that sha256 was computed from, or a fresh one if there is none"""
+        if self._hashed is not None and self._hashed[0] == self.sha256:
+            return self._hashed[1]
+        return self.serialize()
 
     def is_valid(self):
         self.calc_sha256()
@@ -469,7 +759,40 @@ class CTransaction(object):
             % (self.nVersion, repr(self.vin), repr(self.vout), self.nLockTime)
 
 
+# Nonces are tried in chunks of this size, the unit of work of a solver process
+SOLVE_CHUNK = 1 << 16
+NONCE_LIMIT = 1 << 32
+
+
+def grind_nonce(header, target, start, stop):
+    """
+    Return the first nonce in [start, stop) that gives the 76 bytes of
+    block header 'header' a hash <= target, or None.  The SHA256 state
+    after the first 64 bytes is computed once and copied for every nonce.
+
+    >>> genesis = unhexlify("0100000000000000000000000000000000000000000000000000000000000000"
+    ...     "000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa"
+    ...     "4b1e5e4a29ab5f49ffff001d")
+    >>> grind_nonce(genesis, uint256_from_compact(0x1d00ffff), 2083236890, 2083236900)
+    2083236893
+    """
+    midstate = hashlib.sha256(header[:64])
+    tail = header[64:76]
+    pack = struct_u32.pack
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        h.update(tail + pack(nonce))
+        if int.from_bytes(hashlib.sha256(h.digest()).digest(), 'little') <= target:
+            return nonce
+    return None
+
+
 class CBlockHeader(object):
+    __slots__ = ("nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime", "nBits", "nNonce",
+                 "sha256", "hash")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -494,37 +817,25 @@ class CBlockHeader(object):
         self.sha256 = None
         self.hash = None
 
+    @reads_stream
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        (self.nVersion, hashPrevBlock, hashMerkleRoot, self.nTime, self.nBits,
+         self.nNonce) = f.read_struct(struct_block_header)
+        self.hashPrevBlock = uint256_from_str(hashPrevBlock)
+        self.hashMerkleRoot = uint256_from_str(hashMerkleRoot)
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        return struct_block_header.pack(self.nVersion, ser_uint256(self.hashPrevBlock),
+                                        ser_uint256(self.hashMerkleRoot), self.nTime, self.nBits,
+                                        self.nNonce)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
+            h = hash256(CBlockHeader.serialize(self))
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
 
     def gethash(self):
         self.calc_sha256()
@@ -552,35 +863,402 @@ class CBlockHeader(object):
                time.ctime(self.nTime), self.nBits, self.nNonce)
 
 
+class CMerkleTree(object):
+    """
+    Merkle tree of transaction hashes, built the way bitcoind does it: the
+    last node of a level with an odd number of nodes is paired with
+    itself.  All interior hashes are kept (levels[0] are the leaves, the
+    last level holds the root), so appending or replacing a leaf only
+    recomputes the O(log n) hashes above it.
+
+    >>> t = CMerkleTree([1, 2, 3])
+    >>> h12 = hash256(ser_uint256(1) + ser_uint256(2))
+    >>> h33 = hash256(ser_uint256(3) + ser_uint256(3))
+    >>> t.root() == uint256_from_str(hash256(h12 + h33))
+    True
+    >>> t.append(4)
+    >>> t.replace(0, 5)
+    >>> t.root() == CMerkleTree([5, 2, 3, 4]).root()
+    True
+    >>> CMerkleTree.root_from_branch(3, t.branch(2), 2) == t.root()
+    True
+    """
+    def __init__(self, hashes=()):
+        self.build(hashes)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def build(self, hashes):
+        """Recompute the whole tree for the given leaf hashes"""
+        self._build([ser_uint256(h) for h in hashes])
+
+    def _build(self, leaves):
+        self.levels = [leaves]
+        level = leaves
+        while len(level) > 1:
+            last = len(level) - 1
+            level = [hash256(level[i] + level[min(i + 1, last)]) for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    def append(self, h):
+        self.levels[0].append(ser_uint256(h))
+        self._update(len(self.levels[0]) - 1)
+
+    def replace(self, index, h):
+        self.levels[0][index] = ser_uint256(h)
+        self._update(index)
+
+    def _update(self, index):
+        """Recompute the ancestors of leaf 'index'"""
+        height = 0
+        while len(self.levels[height]) > 1:
+            level = self.levels[height]
+            pos = index & ~1
+            h = hash256(level[pos] + level[min(pos + 1, len(level) - 1)])
+            if height + 1 == len(self.levels):
+                self.levels.append([])
+            parent = self.levels[height + 1]
+            index >>= 1
+            if index < len(parent):
+                parent[index] = h
+            else:
+                parent.append(h)
+            height += 1
+
+    def root(self):
+        if not self.levels[0]:
+            return 0
+        return uint256_from_str(self.levels[-1][0])
+
+    def branch(self, index):
+        """The hashes needed to prove that leaf 'index' is in the tree, bottom up"""
+        r = []
+        for level in self.levels[:-1]:
+            sibling = min(index ^ 1, len(level) - 1)
+            r.append(uint256_from_str(level[sibling]))
+            index >>= 1
+        return r
+
+    @staticmethod
+    def root_from_branch(h, branch, index):
+        """The root of the tree that 'branch' proves leaf h at 'index' to be in"""
+        h = ser_uint256(h)
+        for sibling in branch:
+            if index & 1:
+                h = hash256(ser_uint256(sibling) + h)
+            else:
+                h = hash256(h + ser_uint256(sibling))
+            index >>= 1
+        return uint256_from_str(h)
+
+    def partial_tree(self, matches):
+        """The CPartialMerkleTree proving the leaves whose indices are in 'matches'"""
+        matches = set(matches)
+        n = len(self)
+        ptree = CPartialMerkleTree()
+        ptree.nTransactions = n
+
+        def traverse(height, pos):
+            first = pos << height
+            last = min((pos + 1) << height, n)
+            parent_of_match = any(i in matches for i in range(first, last))
+            ptree.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                ptree.vHash.append(uint256_from_str(self.levels[height][pos]))
+            else:
+                traverse(height - 1, pos * 2)
+                if pos * 2 + 1 < len(self.levels[height - 1]):
+                    traverse(height - 1, pos * 2 + 1)
+        if n:
+            traverse(len(self.levels) - 1, 0)
+        return ptree
+
+
+class CPartialMerkleTree(object):
+    """
+    BIP37 partial merkle tree, as found in merkleblock messages and the
+    proofs returned by gettxoutproof.
+
+    >>> t = CMerkleTree(range(1, 8))
+    >>> p = FromHex(CPartialMerkleTree(), ToHex(t.partial_tree([2, 5])))
+    >>> p.extract_matches() == (t.root(), [3, 6], [2, 5])
+    True
+    """
+    def __init__(self):
+        self.nTransactions = 0
+        self.vHash = []
+        self.vBits = []
+
+    @reads_stream
+    def deserialize(self, f):
+        self.nTransactions = f.read_u32()
+        self.vHash = deser_uint256_vector(f)
+        vBytes = f.read_string()
+        self.vBits = [bool(vBytes[i // 8] & (1 << (i % 8))) for i in range(len(vBytes) * 8)]
+
+    def serialize(self):
+        vBytes = bytearray((len(self.vBits) + 7) // 8)
+        for (i, bit) in enumerate(self.vBits):
+            if bit:
+                vBytes[i // 8] |= 1 << (i % 8)
+        return struct_u32.pack(self.nTransactions) + ser_uint256_vector(self.vHash) + ser_string(bytes(vBytes))
+
+    def extract_matches(self):
+        """
+        Return (merkle root, matched transaction hashes, their indices).
+        Raises ValueError if the tree is malformed.
+        """
+        if self.nTransactions == 0 or len(self.vHash) > self.nTransactions:
+            raise ValueError("bad partial merkle tree size")
+        widths = [self.nTransactions]
+        while widths[-1] > 1:
+            widths.append((widths[-1] + 1) // 2)
+        bits = iter(self.vBits)
+        hashes = iter(self.vHash)
+        matched = []
+        indices = []
+
+        def traverse(height, pos):
+            try:
+                parent_of_match = next(bits)
+                if height == 0 or not parent_of_match:
+                    h = next(hashes)
+                    if height == 0 and parent_of_match:
+                        matched.append(h)
+                        indices.append(pos)
+                    return ser_uint256(h)
+            except StopIteration:
+                raise ValueError("partial merkle tree overflowed its data")
+            left = traverse(height - 1, pos * 2)
+            if pos * 2 + 1 < widths[height - 1]:
+                right = traverse(height - 1, pos * 2 + 1)
+                if right == left:
+                    raise ValueError("duplicate hashes in partial merkle tree")
+            else:
+                right = left
+            return hash256(left + right)
+        root = traverse(len(widths) - 1, 0)
+        if next(hashes, None) is not None:
+            raise ValueError("not all hashes of the partial merkle tree were used")
+        return (uint256_from_str(root), matched, indices)
+
+    def __repr__(self):
+        return "CPartialMerkleTree(nTransactions=%d vHash=%s vBits=%s)" \
+            % (self.nTransactions, repr(self.vHash), repr(self.vBits))
+
+
+class CMerkleBlock(object):
+    """A block header with a partial merkle tree, as returned by gettxoutproof"""
+    def __init__(self, header=None, txn=None):
+        self.header = CBlockHeader(header)
+        self.txn = CPartialMerkleTree() if txn is None else txn
+
+    @reads_stream
+    def deserialize(self, f):
+        self.header.deserialize(f)
+        self.txn.deserialize(f)
+
+    def serialize(self):
+        return self.header.serialize() + self.txn.serialize()
+
+    def __repr__(self):
+        return "CMerkleBlock(header=%s txn=%s)" % (repr(self.header), repr(self.txn))
+
+
+class TxList(list):
+    """
+    The list of a CBlock's transactions.  It notes which entries were
+    appended or replaced since the block's merkle tree was last brought up
+    to date; changes it cannot follow (insert, del, sort...) set changed
+    to None.
+    """
+    changed = None  # until unpickling has restored the instance's own
+
+    def __init__(self, txs=()):
+        list.__init__(self, txs)
+        self.changed = set()
+
+    def append(self, tx):
+        list.append(self, tx)
+        if self.changed is not None:
+            self.changed.add(len(self) - 1)
+
+    def extend(self, txs):
+        start = len(self)
+        list.extend(self, txs)
+        if self.changed is not None:
+            self.changed.update(range(start, len(self)))
+
+    def __iadd__(self, txs):
+        self.extend(txs)
+        return self
+
+    def __setitem__(self, index, tx):
+        list.__setitem__(self, index, tx)
+        if self.changed is not None:
+            if isinstance(index, int):
+                self.changed.add(index % len(self))
+            else:
+                self.changed = None
+
+    def __delitem__(self, index):
+        self.changed = None
+        list.__delitem__(self, index)
+
+    def __imul__(self, n):
+        self.changed = None
+        return list.__imul__(self, n)
+
+    def insert(self, index, tx):
+        self.changed = None
+        list.insert(self, index, tx)
+
+    def pop(self, index=-1):
+        self.changed = None
+        return list.pop(self, index)
+
+    def remove(self, tx):
+        self.changed = None
+        list.remove(self, tx)
+
+    def clear(self):
+        self.changed = None
+        list.clear(self)
+
+    def sort(self, *args, **kwargs):
+        self.changed = None
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self.changed = None
+        list.reverse(self)
+
+
 class CBlock(CBlockHeader):
+    """
+    serialize() writes each hashed transaction from the bytes its hash was
+    computed from (see CTransaction.serialize_cached()), so a block is not
+    serialized again every time it is stored or sent.  A transaction that
+    is changed in place after it was hashed must therefore be rehash()ed
+    before the block is serialized, just as before its hash or the merkle
+    root are used.  To build a block whose merkle root does not match its
+    transactions, rehash() the changed transaction and leave
+    hashMerkleRoot alone.
+
+    >>> block = CBlock()
+    >>> block.vtx.append(CTransaction())
+    >>> block.vtx[0].vout.append(CTxOut(1, b"a"))
+    >>> block.hashMerkleRoot = block.calc_merkle_root()
+    >>> block.vtx[0].vout[0].nValue = 2
+    >>> FromHex(CBlock(), ToHex(block)).vtx[0].vout[0].nValue
+    1
+    >>> block.vtx[0].rehash()
+    >>> FromHex(CBlock(), ToHex(block)).vtx[0].vout[0].nValue
+    2
+    >>> block.calc_merkle_root() == block.hashMerkleRoot
+    False
+    """
+    __slots__ = ("vtx", "_merkle_tree", "_merkle_state")
+    __getstate__ = slots_getstate
+    __setstate__ = slots_setstate
+
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
-        self.vtx = []
+        self.vtx = TxList()
+        self._merkle_tree = None
+        self._merkle_state = None
 
+    @reads_stream
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
-        self.vtx = deser_vector(f, CTransaction)
+        self.vtx = TxList(deser_vector(f, CTransaction))
 
     def serialize(self):
-        r = b""
-        r += super(CBlock, self).serialize()
-        r += ser_vector(self.vtx)
-        return r
-
-    def calc_merkle_root(self):
-        hashes = []
+        # transactions that are hashed (e.g. by calc_merkle_root) are not
+        # serialized again
+        return b"".join([super(CBlock, self).serialize(), ser_compact_size(len(self.vtx))] +
+                        [tx.serialize_cached() for tx in self.vtx])
+
+    def tx_leaves(self):
+        """The serialized hashes of vtx, i.e. the leaves of the merkle tree"""
+        leaves = []
         for tx in self.vtx:
             tx.calc_sha256()
-            hashes.append(ser_uint256(tx.sha256))
-        while len(hashes) > 1:
-            newhashes = []
-            for i in range(0, len(hashes), 2):
-                i2 = min(i + 1, len(hashes) - 1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        if hashes:
-            return uint256_from_str(hashes[0])
-        return 0
+            leaves.append(ser_uint256(tx.sha256))
+        return leaves
+
+    def get_merkle_tree(self):
+        """
+        The CMerkleTree of vtx, kept with the block.  Each transaction
+        appended to or replaced in vtx since the last call costs O(log n)
+        hashes.  All of vtx is only looked at again if it is not a TxList
+        (it was replaced by a plain list, say), was changed in some other
+        way, or a transaction's hash has changed since, as rehash() after
+        changing one in place does.
+
+        >>> block = CBlock()
+        >>> for n in range(5):
+        ...     block.vtx.append(CTransaction())
+        ...     block.vtx[n].nLockTime = n
+        ...     root = block.calc_merkle_root()
+        >>> block.vtx[2].nLockTime = 7
+        >>> block.vtx[2].rehash()
+        >>> block.vtx += [CTransaction()]
+        >>> block.calc_merkle_root() == CMerkleTree([tx.sha256 for tx in block.vtx]).root()
+        True
+        """
+        vtx = self.vtx
+        tree = self._merkle_tree
+        state = self._merkle_state
+        if (tree is not None and state is not None and state[0] is vtx and vtx.changed is not None
+                and state[1] == CTransaction.hash_changes and 2 * len(vtx.changed) <= len(vtx)):
+            leaves = tree.levels[0]
+            for i in sorted(vtx.changed):
+                tx = vtx[i]
+                tx.calc_sha256()
+                leaf = ser_uint256(tx.sha256)
+                if i == len(leaves):
+                    leaves.append(leaf)
+                elif leaves[i] != leaf:
+                    leaves[i] = leaf
+                else:
+                    continue
+                tree._update(i)
+            vtx.changed = set()
+            self._merkle_state = (vtx, CTransaction.hash_changes)
+            return tree
+        tree = self._scan_merkle_tree()
+        if isinstance(vtx, TxList):
+            vtx.changed = set()
+            self._merkle_state = (vtx, CTransaction.hash_changes)
+        else:
+            self._merkle_state = None
+        return tree
+
+    def _scan_merkle_tree(self):
+        """Bring the tree up to date by comparing all of vtx with its leaves"""
+        leaves = self.tx_leaves()
+        tree = self._merkle_tree
+        if tree is None or len(leaves) < len(tree):
+            tree = self._merkle_tree = CMerkleTree()
+            tree._build(leaves)
+            return tree
+        old = tree.levels[0]
+        changed = [i for i in range(len(old)) if old[i] != leaves[i]]
+        if 2 * (len(changed) + len(leaves) - len(old)) > len(leaves):
+            tree._build(leaves)
+            return tree
+        for i in changed:
+            old[i] = leaves[i]
+            tree._update(i)
+        for i in range(len(old), len(leaves)):
+            old.append(leaves[i])
+            tree._update(i)
+        return tree
+
+    def calc_merkle_root(self):
+        return self.get_merkle_tree().root()
 
     def is_valid(self):
         self.calc_sha256()
@@ -594,12 +1272,45 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
+    def solve(self, processes=None):
+        """
+        Find the lowest nNonce starting from the current one that satisfies
+        nBits, optionally spreading the nonce space over 'processes' worker
+        processes.  Gives the same nonce as trying them one by one.
+        """
         self.rehash()
         target = uint256_from_compact(self.nBits)
-        while self.sha256 > target:
-            self.nNonce += 1
-            self.rehash()
+        if self.sha256 <= target:
+            return
+        header = CBlockHeader.serialize(self)[:76]
+        start = self.nNonce + 1
+        nonce = None
+        if processes is None or processes < 2:
+            for begin in range(start, NONCE_LIMIT, SOLVE_CHUNK):
+                nonce = grind_nonce(header, target, begin, min(begin + SOLVE_CHUNK, NONCE_LIMIT))
+                if nonce is not None:
+                    break
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                for begin in range(start, NONCE_LIMIT, SOLVE_CHUNK * processes):
+                    # one chunk per worker per round; the earliest chunk
+                    # with a solution wins so the result is deterministic
+                    futures = [pool.submit(grind_nonce, header, target, b, min(b + SOLVE_CHUNK, NONCE_LIMIT))
+                               for b in range(begin, min(begin + SOLVE_CHUNK * processes, NONCE_LIMIT),
+                                              SOLVE_CHUNK)]
+                    for (i, f) in enumerate(futures):
+                        nonce = f.result()
+                        if nonce is not None:
+                            # later chunks can't give a lower nonce
+                            for pending in futures[i + 1:]:
+                                pending.cancel()
+                            break
+                    if nonce is not None:
+                        break
+        if nonce is None:
+            raise ValueError("no nonce >= %d solves the block" % start)
+        self.nNonce = nonce
+        self.rehash()
 
     def __str__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx_len=%d)" \
@@ -612,6 +1323,188 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
+
+def skip_transaction(buf, pos):
+    """Return the position just after the serialized transaction at buf[pos]"""
+    (n, pos) = skip_compact_size(buf, pos + 4)
+    for i in range(n):
+        (size, pos) = skip_compact_size(buf, pos + 36)
+        pos += size + 4
+    (n, pos) = skip_compact_size(buf, pos)
+    for i in range(n):
+        (size, pos) = skip_compact_size(buf, pos + 8)
+        pos += size
+    pos += 4
+    if pos > len(buf):
+        raise ValueError("truncated transaction")
+    return pos
+
+
+class LazyTransactions(MutableSequence):
+    """
+    The vtx of a CLazyBlock: a list of transactions that are only parsed
+    from the block's serialization when they are accessed.  Transactions
+    that were never accessed are serialized and hashed from the original
+    bytes.  Parsed ones have their hash computed from those bytes as well,
+    so serialize_cached() keeps returning them until the transaction is
+    rehash()ed after a change.
+    """
+    def __init__(self, data=b"", spans=(), txs=None):
+        self._data = memoryview(data)
+        self._spans = list(spans)
+        self._txs = [None] * len(self._spans) if txs is None else list(txs)
+        self._untouched = txs is None
+        self._parsed = {}  # index -> sha256 of the transactions parsed while untouched
+
+    @classmethod
+    def from_reader(cls, f):
+        """Index the transaction vector at the current position of ByteReader f"""
+        buf = f.buf
+        start = f.pos
+        (count, pos) = skip_compact_size(buf, start)
+        spans = []
+        for i in range(count):
+            end = skip_transaction(buf, pos)
+            spans.append((pos - start, end - start))
+            pos = end
+        return cls(f.read_view(pos - start), spans)
+
+    def __len__(self):
+        return len(self._txs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._txs)))]
+        tx = self._txs[i]
+        if tx is None:
+            (start, end) = self._spans[i]
+            data = self._data[start:end].tobytes()
+            tx = CTransaction()
+            tx.deserialize(ByteReader(data))
+            h = hash256(data)
+            tx.sha256 = uint256_from_str(h)
+            tx.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+            tx._hashed = (tx.sha256, data)
+            self._txs[i] = tx
+            self._parsed[i] = tx.sha256
+        return tx
+
+    def __setitem__(self, i, tx):
+        if isinstance(i, slice):
+            # materialize everything first, then let the list do the work
+            txs = self[:]
+            txs[i] = tx
+            self._txs = txs
+            self._spans = [None] * len(txs)
+        else:
+            self._txs[i] = tx
+            self._spans[i] = None
+        self._untouched = False
+
+    def __delitem__(self, i):
+        del self._txs[i]
+        del self._spans[i]
+        self._untouched = False
+
+    def insert(self, i, tx):
+        self._txs.insert(i, tx)
+        self._spans.insert(i, None)
+        self._untouched = False
+
+    def __eq__(self, other):
+        return isinstance(other, (list, LazyTransactions)) and list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        return (LazyTransactions, (self._data.tobytes(), self._spans, self._txs))
+
+    def is_parsed(self, i):
+        return self._txs[i] is not None
+
+    def raw(self, i):
+        """The serialization of transaction i"""
+        tx = self._txs[i]
+        if tx is None:
+            (start, end) = self._spans[i]
+            return self._data[start:end]
+        return tx.serialize_cached()
+
+    def leaves(self):
+        """The serialized hashes of the transactions, without parsing any"""
+        r = []
+        for (i, tx) in enumerate(self._txs):
+            if tx is None:
+                (start, end) = self._spans[i]
+                r.append(hash256(self._data[start:end]))
+            else:
+                tx.calc_sha256()
+                r.append(ser_uint256(tx.sha256))
+        return r
+
+    def serialize(self):
+        """The transaction vector, reusing the original bytes where possible"""
+        if self._untouched and all(self._txs[i].sha256 == h for (i, h) in self._parsed.items()):
+            return self._data.tobytes()
+        return b"".join([ser_compact_size(len(self._txs))] + [self.raw(i) for i in range(len(self._txs))])
+
+
+class CLazyBlock(CBlock):
+    """
+    A CBlock whose header is parsed right away but whose transactions are
+    only indexed, and parsed one at a time as vtx is accessed (see
+    LazyTransactions).  The transactions stay in a view of the data the
+    block was read from, so a block read from a ByteReader over a mapped
+    file is not copied into memory.  vtx may be replaced by a plain list.
+
+    >>> block = CBlock()
+    >>> for n in range(3):
+    ...     tx = CTransaction()
+    ...     tx.nLockTime = n
+    ...     block.vtx.append(tx)
+    >>> data = block.serialize()
+    >>> lazy = FromHex(CLazyBlock(), ToHex(block))
+    >>> (len(lazy.vtx), lazy.vtx.is_parsed(1))
+    (3, False)
+    >>> lazy.calc_merkle_root() == block.calc_merkle_root()
+    True
+    >>> (lazy.vtx[1].nLockTime, lazy.vtx.is_parsed(1), lazy.serialize() == data)
+    (1, True, True)
+    >>> lazy.vtx[1].nLockTime = 5
+    >>> lazy.vtx[1].rehash()
+    >>> lazy.serialize() == data
+    False
+
+    A block read from a BytesIO keeps a copy of its transactions, not the
+    BytesIO's buffer:
+
+    >>> stream = io.BytesIO(data)
+    >>> lazy = CLazyBlock()
+    >>> lazy.deserialize(stream)
+    >>> (stream.write(b"more"), stream.close(), lazy.serialize() == data)
+    (4, None, True)
+    """
+    __slots__ = ()
+
+    @reads_stream
+    def deserialize(self, f):
+        CBlockHeader.deserialize(self, f)
+        self.vtx = LazyTransactions.from_reader(f)
+        self._merkle_tree = None
+        self._merkle_state = None
+
+    def serialize(self):
+        if not isinstance(self.vtx, LazyTransactions):
+            return super(CLazyBlock, self).serialize()
+        return CBlockHeader.serialize(self) + self.vtx.serialize()
+
+    def tx_leaves(self):
+        if not isinstance(self.vtx, LazyTransactions):
+            return super(CLazyBlock, self).tx_leaves()
+        return self.vtx.leaves()
+
+
 class CUnsignedAlert(object):
     def __init__(self):
         self.nVersion = 1
@@ -628,33 +1521,34 @@ class CUnsignedAlert(object):
         self.strStatusBar = b""
         self.strReserved = b""
 
+    @reads_stream
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nRelayUntil = struct.unpack("<q", f.read(8))[0]
-        self.nExpiration = struct.unpack("<q", f.read(8))[0]
-        self.nID = struct.unpack("<i", f.read(4))[0]
-        self.nCancel = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = f.read_i32()
+        self.nRelayUntil = f.read_i64()
+        self.nExpiration = f.read_i64()
+        self.nID = f.read_i32()
+        self.nCancel = f.read_i32()
         self.setCancel = deser_int_vector(f)
-        self.nMinVer = struct.unpack("<i", f.read(4))[0]
-        self.nMaxVer = struct.unpack("<i", f.read(4))[0]
+        self.nMinVer = f.read_i32()
+        self.nMaxVer = f.read_i32()
         self.setSubVer = deser_string_vector(f)
-        self.nPriority = struct.unpack("<i", f.read(4))[0]
-        self.strComment = deser_string(f)
-        self.strStatusBar = deser_string(f)
-        self.strReserved = deser_string(f)
+        self.nPriority = f.read_i32()
+        self.strComment = f.read_string()
+        self.strStatusBar = f.read_string()
+        self.strReserved = f.read_string()
 
     def serialize(self):
         r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<q", self.nRelayUntil)
-        r += struct.pack("<q", self.nExpiration)
-        r += struct.pack("<i", self.nID)
-        r += struct.pack("<i", self.nCancel)
+        r += struct_i32.pack(self.nVersion)
+        r += struct_i64.pack(self.nRelayUntil)
+        r += struct_i64.pack(self.nExpiration)
+        r += struct_i32.pack(self.nID)
+        r += struct_i32.pack(self.nCancel)
         r += ser_int_vector(self.setCancel)
-        r += struct.pack("<i", self.nMinVer)
-        r += struct.pack("<i", self.nMaxVer)
+        r += struct_i32.pack(self.nMinVer)
+        r += struct_i32.pack(self.nMaxVer)
         r += ser_string_vector(self.setSubVer)
-        r += struct.pack("<i", self.nPriority)
+        r += struct_i32.pack(self.nPriority)
         r += ser_string(self.strComment)
         r += ser_string(self.strStatusBar)
         r += ser_string(self.strReserved)
@@ -672,9 +1566,10 @@ class CAlert(object):
         self.vchMsg = b""
         self.vchSig = b""
 
+    @reads_stream
     def deserialize(self, f):
-        self.vchMsg = deser_string(f)
-        self.vchSig = deser_string(f)
+        self.vchMsg = f.read_string()
+        self.vchSig = f.read_string()
 
     def serialize(self):
         r = b""
@@ -701,21 +1596,22 @@ class msg_version(object):
         self.strSubVer = MY_SUBVERSION
         self.nStartingHeight = -1
 
+    @reads_stream
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = f.read_i32()
         if self.nVersion == 10300:
             self.nVersion = 300
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nServices = f.read_u64()
+        self.nTime = f.read_i64()
         self.addrTo = CAddress()
         self.addrTo.deserialize(f)
         if self.nVersion >= 106:
             self.addrFrom = CAddress()
             self.addrFrom.deserialize(f)
-            self.nNonce = struct.unpack("<Q", f.read(8))[0]
-            self.strSubVer = deser_string(f)
+            self.nNonce = f.read_u64()
+            self.strSubVer = f.read_string()
             if self.nVersion >= 209:
-                self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+                self.nStartingHeight = f.read_i32()
             else:
                 self.nStartingHeight = None
         else:
@@ -726,14 +1622,14 @@ class msg_version(object):
 
     def serialize(self):
         r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
+        r += struct_i32.pack(self.nVersion)
+        r += struct_u64.pack(self.nServices)
+        r += struct_i64.pack(self.nTime)
         r += self.addrTo.serialize()
         r += self.addrFrom.serialize()
-        r += struct.pack("<Q", self.nNonce)
+        r += struct_u64.pack(self.nNonce)
         r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
+        r += struct_i32.pack(self.nStartingHeight)
         return r
 
     def __repr__(self):
@@ -749,6 +1645,7 @@ class msg_verack(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         pass
 
@@ -765,6 +1662,7 @@ class msg_addr(object):
     def __init__(self):
         self.addrs = []
 
+    @reads_stream
     def deserialize(self, f):
         self.addrs = deser_vector(f, CAddress)
 
@@ -781,6 +1679,7 @@ class msg_alert(object):
     def __init__(self):
         self.alert = CAlert()
 
+    @reads_stream
     def deserialize(self, f):
         self.alert = CAlert()
         self.alert.deserialize(f)
@@ -803,6 +1702,7 @@ class msg_inv(object):
         else:
             self.inv = inv
 
+    @reads_stream
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
@@ -824,6 +1724,7 @@ class msg_getdata(object):
         else:
             self.inv = [inv]
 
+    @reads_stream
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
@@ -841,10 +1742,11 @@ class msg_getblocks(object):
         self.locator = CBlockLocator()
         self.hashstop = 0
 
+    @reads_stream
     def deserialize(self, f):
         self.locator = CBlockLocator()
         self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        self.hashstop = f.read_uint256()
 
     def serialize(self):
         r = b""
@@ -863,6 +1765,7 @@ class msg_tx(object):
     def __init__(self, tx=CTransaction()):
         self.tx = tx
 
+    @reads_stream
     def deserialize(self, f):
         self.tx.deserialize(f)
 
@@ -878,10 +1781,11 @@ class msg_block(object):
 
     def __init__(self, block=None):
         if block is None:
-            self.block = CBlock()
+            self.block = CLazyBlock()
         else:
             self.block = block
 
+    @reads_stream
     def deserialize(self, f):
         self.block.deserialize(f)
 
@@ -901,6 +1805,7 @@ class msg_getaddr(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         pass
 
@@ -917,6 +1822,7 @@ class msg_ping_prebip31(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         pass
 
@@ -933,12 +1839,13 @@ class msg_ping(object):
     def __init__(self, nonce=0):
         self.nonce = nonce
 
+    @reads_stream
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = f.read_u64()
 
     def serialize(self):
         r = b""
-        r += struct.pack("<Q", self.nonce)
+        r += struct_u64.pack(self.nonce)
         return r
 
     def __repr__(self):
@@ -951,12 +1858,13 @@ class msg_pong(object):
     def __init__(self, nonce=0):
         self.nonce = nonce
 
+    @reads_stream
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = f.read_u64()
 
     def serialize(self):
         r = b""
-        r += struct.pack("<Q", self.nonce)
+        r += struct_u64.pack(self.nonce)
         return r
 
     def __repr__(self):
@@ -969,6 +1877,7 @@ class msg_mempool(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         pass
 
@@ -985,6 +1894,7 @@ class msg_sendheaders(object):
     def __init__(self):
         pass
 
+    @reads_stream
     def deserialize(self, f):
         pass
 
@@ -1008,10 +1918,11 @@ class msg_getheaders(object):
         self.locator = CBlockLocator()
         self.hashstop = 0
 
+    @reads_stream
     def deserialize(self, f):
         self.locator = CBlockLocator()
         self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        self.hashstop = f.read_uint256()
 
     def serialize(self):
         r = b""
@@ -1034,6 +1945,7 @@ class msg_headers(object):
     def __init__(self):
         self.headers = []
 
+    @reads_stream
     def deserialize(self, f):
         # comment in bitcoind indicates these should be deserialized as blocks
         blocks = deser_vector(f, CBlock)
@@ -1058,17 +1970,18 @@ class msg_reject(object):
         self.reason = b""
         self.data = 0
 
+    @reads_stream
     def deserialize(self, f):
-        self.message = deser_string(f)
-        self.code = struct.unpack("<B", f.read(1))[0]
-        self.reason = deser_string(f)
+        self.message = f.read_string()
+        self.code = f.read_u8()
+        self.reason = f.read_string()
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
-            self.data = deser_uint256(f)
+            self.data = f.read_uint256()
 
     def serialize(self):
         r = ser_string(self.message)
-        r += struct.pack("<B", self.code)
+        r += struct_u8.pack(self.code)
         r += ser_string(self.reason)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
@@ -1080,8 +1993,43 @@ class msg_reject(object):
             % (self.message, self.code, self.reason, self.data)
 
 
-
 def Test():
     import doctest
     import sys
     print(doctest.testmod(sys.modules[__name__],verbose=True))
+
+
+def Benchmark(ntx=4000, nin=2, nout=2):
+    """
+    Build, serialize and parse a block of ntx transactions with nin inputs
+    and nout outputs each, and print the time taken and the peak memory
+    allocated while the block was built and while it was parsed.
+    """
+    import tracemalloc
+
+    def build():
+        block = CBlock()
+        for i in range(ntx):
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(i, n), b"\x00" * 107, 0xffffffff) for n in range(nin)]
+            tx.vout = [CTxOut(50000, b"\x00" * 25) for n in range(nout)]
+            block.vtx.append(tx)
+        return block
+
+    tracemalloc.start()
+    start = time.time()
+    block = build()
+    build_time = time.time() - start
+    build_mem = tracemalloc.get_traced_memory()[1]
+    data = block.serialize()
+    del block
+    tracemalloc.reset_peak()
+    start = time.time()
+    block = CBlock()
+    block.deserialize(ByteReader(data))
+    parse_time = time.time() - start
+    parse_mem = tracemalloc.get_traced_memory()[1] - len(data)
+    tracemalloc.stop()
+    print("%d transactions, %d bytes serialized" % (ntx, len(data)))
+    print("build: %.3f s, %.1f MB peak" % (build_time, build_mem / 1e6))
+    print("parse: %.3f s, %.1f MB peak" % (parse_time, parse_mem / 1e6))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# signer.py - sign transactions in the test instead of via signrawtransaction
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Keys are exported from a node once (dumpprivkey) and P2PKH / P2PK inputs
+# are then signed locally, optionally spread over worker processes.  Once
+# the MVF hard fork is active signatures must commit to the fork id, see
+# node_forkid().
+#
+
+from .mininode import *
+from .script import CScript, SignatureHash, SIGHASH_ALL, SIGHASH_ANYONECANPAY, OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG
+from .key import CECKey
+from .util import HARDFORK_SIGHASH_ID_DEFAULT, bytes_to_hex_str, hex_str_to_bytes
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+
+# Below this many inputs signing in the test process beats shipping the
+# transaction to the workers
+SIGN_POOL_MIN_INPUTS = 32
+
+B58_DIGITS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+def b58decode_check(s):
+    """Decode a base58check string, returning version byte + payload
+
+    >>> hexlify(b58decode_check('1BitcoinEaterAddressDontSendf59kuE'))
+    b'00759d6677091e973b9e9d99f19c68fbf43e3f05f9'
+    """
+    n = 0
+    for c in s:
+        n = n * 58 + B58_DIGITS.index(c)
+    data = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    data = b'\x00' * (len(s) - len(s.lstrip('1'))) + data
+    if len(data) < 4 or hash256(data[:-4])[:4] != data[-4:]:
+        raise ValueError("bad base58 checksum: %s" % s)
+    return data[:-4]
+
+def hash160(s):
+    return hashlib.new('ripemd160', hashlib.sha256(s).digest()).digest()
+
+def node_forkid(node):
+    """
+    The fork id node expects signatures to commit to: 0 before the hard fork,
+    HARDFORK_SIGHASH_ID after it (a -forkid override is not visible over RPC
+    once the fork is active).
+    """
+    if "hardforks" in node.getblockchaininfo():
+        return 0
+    return HARDFORK_SIGHASH_ID_DEFAULT
+
+# Per worker process cache of CECKey objects, which cannot be pickled
+_keys = {}
+
+def get_key(secret, compressed):
+    key = _keys.get((secret, compressed))
+    if key is None:
+        key = CECKey()
+        key.set_secretbytes(secret)
+        key.set_compressed(compressed)
+        _keys[(secret, compressed)] = key
+    return key
+
+class SighashAll(object):
+    """
+    SignatureHash() for SIGHASH_ALL, which serializes the transaction once
+    and then only hashes per input: input i's preimage is the same as for
+    every other input except for its own scriptSig (the scriptCode), so the
+    hash of everything before it is carried along as a sha256 midstate.
+    Only valid for scripts without OP_CODESEPARATOR, as P2PKH and P2PK are.
+    """
+
+    def __init__(self, tx, hashtype, forkid):
+        self.tx = tx
+        head = struct_i32.pack(tx.nVersion) + ser_compact_size(len(tx.vin))
+        # every input with an empty scriptSig, then outputs and locktime
+        ins = [ txin.prevout.serialize() + b'\x00' + struct_u32.pack(txin.nSequence) for txin in tx.vin ]
+        self.rest = memoryview(b"".join(ins) + ser_vector(tx.vout) + struct_u32.pack(tx.nLockTime) +
+                               struct_u32.pack((forkid << 1) | hashtype))
+        self.ends = list(itertools.accumulate(len(x) for x in ins))
+        self.prefix = hashlib.sha256(head)
+        self.pos = 0
+        self.n = 0
+
+    def __call__(self, i, script):
+        if i < self.n:
+            raise ValueError("SighashAll inputs must be hashed in order")
+        start = self.ends[i - 1] if i else 0
+        self.prefix.update(self.rest[self.pos:start])
+        (self.pos, self.n) = (start, i)
+        h = self.prefix.copy()
+        txin = self.tx.vin[i]
+        h.update(txin.prevout.serialize() + ser_string(script) + struct_u32.pack(txin.nSequence))
+        h.update(self.rest[self.ends[i]:])
+        return hashlib.sha256(h.digest()).digest()
+
+def sign_inputs(txdata, jobs, hashtype, forkid):
+    """
+    Sign inputs of the serialized transaction txdata.  jobs is a list of
+    (input index, scriptPubKey, secret, compressed) in input order; returns
+    a list of (input index, scriptSig).
+    """
+    tx = CTransaction()
+    tx.deserialize(ByteReader(txdata))
+    if hashtype & (0x1f | SIGHASH_ANYONECANPAY) == SIGHASH_ALL:
+        sighash_all = SighashAll(tx, hashtype, forkid)
+    else:
+        sighash_all = None
+    result = []
+    for (i, script, secret, compressed) in jobs:
+        key = get_key(secret, compressed)
+        if sighash_all is not None:
+            sighash = sighash_all(i, script)
+        else:
+            (sighash, err) = SignatureHash(CScript(script), tx, i, hashtype, forkid)
+            if err is not None:
+                raise ValueError(err)
+        sig = key.sign(sighash, low_s=True) + bytes([hashtype & 0xff])
+        if script[0] == OP_DUP:
+            result.append((i, bytes(CScript([sig, key.get_pubkey()]))))
+        else:
+            result.append((i, bytes(CScript([sig]))))
+    return result
+
+
+class TxSigner(object):
+    """
+    Signs P2PKH and P2PK inputs with keys held by the test, e.g.
+
+        signer = TxSigner(node_forkid(node))
+        utxos = node.listunspent()
+        signer.import_keys(node, [u["address"] for u in utxos])
+        signer.sign(tx, [u["scriptPubKey"] for u in utxos])
+
+    Transactions with at least SIGN_POOL_MIN_INPUTS inputs are signed over
+    'processes' worker processes when that is 2 or more.  Given a node,
+    signrawtransaction() also exports the keys of prevtxs it has none for
+    (coins mined to fresh keypool addresses, say).
+    """
+
+    def __init__(self, forkid=0, processes=None, node=None):
+        self.forkid = forkid
+        self.processes = processes
+        self.node = node
+        self.pool = None
+        self.addresses = set()
+        # hash160(pubkey) and pubkey -> (secret, compressed)
+        self.keys = {}
+
+    def add_key(self, wif):
+        """Add a private key in wallet import format"""
+        data = b58decode_check(wif)[1:]
+        compressed = len(data) == 33 and data[32] == 1
+        secret = data[:32]
+        pubkey = get_key(secret, compressed).get_pubkey()
+        self.keys[hash160(pubkey)] = (secret, compressed)
+        self.keys[pubkey] = (secret, compressed)
+
+    def import_keys(self, node, addresses):
+        """Export the keys of addresses from node, one dumpprivkey each"""
+        for address in addresses:
+            if address not in self.addresses:
+                self.add_key(node.dumpprivkey(address))
+                self.addresses.add(address)
+
+    def find_key(self, script):
+        """The (secret, compressed) that can spend script, or None"""
+        if (len(script) == 25 and script[:3] == bytes([OP_DUP, OP_HASH160, 20])
+                and script[23:] == bytes([OP_EQUALVERIFY, OP_CHECKSIG])):
+            return self.keys.get(script[3:23])
+        if len(script) in (35, 67) and script[0] == len(script) - 2 and script[-1] == OP_CHECKSIG:
+            return self.keys.get(script[1:-1])
+        return None
+
+    def sign(self, tx, scripts, hashtype=SIGHASH_ALL):
+        """
+        Sign every input of tx, in place; scripts[i] is the scriptPubKey
+        (bytes or hex) spent by input i.  Raises KeyError for inputs we
+        have no key for.
+        """
+        jobs = []
+        for (i, script) in enumerate(scripts):
+            if isinstance(script, str):
+                script = hex_str_to_bytes(script)
+            key = self.find_key(script)
+            if key is None:
+                raise KeyError("no key for input %d (%s)" % (i, bytes_to_hex_str(script)))
+            jobs.append((i, script) + key)
+        txdata = tx.serialize()
+        if self.processes is None or self.processes < 2 or len(jobs) < SIGN_POOL_MIN_INPUTS:
+            results = [sign_inputs(txdata, jobs, hashtype, self.forkid)]
+        else:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.processes)
+            step = (len(jobs) + self.processes - 1) // self.processes
+            futures = [self.pool.submit(sign_inputs, txdata, jobs[b:b + step], hashtype, self.forkid)
+                       for b in range(0, len(jobs), step)]
+            results = [f.result() for f in futures]
+        for result in results:
+            for (i, script_sig) in result:
+                tx.vin[i].scriptSig = script_sig
+        tx.rehash()
+        return tx
+
+    def signrawtransaction(self, hexstring, prevtxs, hashtype=SIGHASH_ALL):
+        """
+        Drop-in for the signrawtransaction RPC: prevtxs are dicts with a
+        "scriptPubKey" (listunspent entries will do), one per input.
+        """
+        if self.node is not None:
+            self.import_keys(self.node, [p["address"] for p in prevtxs if p.get("address") and
+                                         self.find_key(hex_str_to_bytes(p["scriptPubKey"])) is None])
+        tx = FromHex(CTransaction(), hexstring)
+        try:
+            self.sign(tx, [p["scriptPubKey"] for p in prevtxs], hashtype)
+        except KeyError as e:
+            return {"hex": hexstring, "complete": False, "errors": [{"error": e.args[0]}]}
+        return {"hex": ToHex(tx), "complete": True}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
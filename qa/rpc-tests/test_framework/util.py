@@ -22,14 +22,23 @@ import decimal
 import json
 import random
 import shutil
+import socket
 import subprocess
+import tempfile
 import time
 import re
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse as urlparse
 import errno
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
+from .asyncproxy import AsyncAuthServiceProxy
 
 COVERAGE_DIR = None
 
@@ -108,45 +117,133 @@ def get_rpc_proxy(url, node_number, timeout=None):
     return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
 
 
+def get_async_rpc_proxy(url, node_number, timeout=None, max_connections=None):
+    """
+    Like get_rpc_proxy, but returns an AsyncAuthServiceProxy whose RPC
+    methods are coroutines, e.g. "await proxy.getblockcount()".
+
+    Kwargs:
+        timeout (int): HTTP timeout in seconds
+        max_connections (int): number of concurrent HTTP connections
+    """
+    proxy_kwargs = {}
+    if timeout is not None:
+        proxy_kwargs['timeout'] = timeout
+    if max_connections is not None:
+        proxy_kwargs['max_connections'] = max_connections
+
+    proxy = AsyncAuthServiceProxy(url, **proxy_kwargs)
+
+    coverage_logfile = coverage.get_filename(
+        COVERAGE_DIR, node_number) if COVERAGE_DIR else None
+
+    return coverage.AsyncAuthServiceProxyWrapper(proxy, coverage_logfile)
+
+
+# Port allocation
+#
+# Each test process reserves a block of PORT_BLOCK_SIZE p2p ports in
+# [PORT_MIN, PORT_MIN + PORT_RANGE) together with the rpc ports PORT_RANGE
+# above them (interconnect_nodes relies on rpc port - 1000 == p2p port).
+# A block is claimed by holding an flock on its lock file in PORT_LOCK_DIR,
+# so concurrently running tests never pick the same ports, and is only taken
+# if none of its ports is already bound by somebody else.  The kernel releases
+# the locks of processes that died, so crashed runs leave nothing stale.
+#
+# Ports can still be forced through the node<n> / rpcnode<n> environment
+# variables.
+PORT_MIN = 11000
+PORT_RANGE = 1000
+PORT_BLOCK_SIZE = 20
+PORT_LOCK_DIR = os.path.join(tempfile.gettempdir(), "bitcoin-rpc-tests-ports")
+
+_port_block = None
+
+def _port_is_free(port):
+    """Return True if nobody is listening on the given local port"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # bitcoind uses SO_REUSEADDR too, so TIME_WAIT leftovers don't count
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("127.0.0.1", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+def _try_lock_port_block(block):
+    """Lock the file of a port block, return the lock (to release) or None"""
+    lockname = os.path.join(PORT_LOCK_DIR, "block%d.lock" % block)
+    if fcntl is None:
+        # no flock: fall back to exclusive creation, stale files of crashed
+        # runs then have to be removed by hand
+        try:
+            os.close(os.open(lockname, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+        return lockname
+    # The lock files are never removed; holding a flock on one is what owns
+    # the block, and the kernel drops it when the holder exits or dies.
+    fd = os.open(lockname, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+def _release_port_block(lock):
+    try:
+        if isinstance(lock, int):
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+        else:
+            os.remove(lock)
+    except OSError:
+        pass
+
+def port_block_base():
+    """Reserve (once per process) a block of ports and return its first p2p port"""
+    global _port_block
+    if _port_block is None:
+        os.makedirs(PORT_LOCK_DIR, exist_ok=True)
+        num_blocks = PORT_RANGE // PORT_BLOCK_SIZE
+        first = os.getpid() % num_blocks
+        for i in range(num_blocks):
+            block = (first + i) % num_blocks
+            lock = _try_lock_port_block(block)
+            if lock is None:
+                continue
+            base = PORT_MIN + block * PORT_BLOCK_SIZE
+            if all(_port_is_free(base + n) and _port_is_free(base + PORT_RANGE + n)
+                   for n in range(PORT_BLOCK_SIZE)):
+                atexit.register(_release_port_block, lock)
+                _port_block = base
+                break
+            _release_port_block(lock)
+        else:
+            raise RuntimeError("No free block of %d ports found in %d-%d" %
+                               (PORT_BLOCK_SIZE, PORT_MIN, PORT_MIN + PORT_RANGE + PORT_RANGE - 1))
+    return _port_block
+
 def p2p_port(n):
     #If port is already defined then return port
     if os.getenv("node" + str(n)):
         return int(os.getenv("node" + str(n)))
-    #If no port defined then find an available port
-    if n == 0:
-        port = 11000 + n + os.getpid()%990
-    else:
-        port = int(os.getenv("node" + str(n-1))) + 1
-    from subprocess import check_output
-    netStatOut = check_output(["netstat", "-n"])
-    for portInUse in re.findall(b"tcp.*?:(11\d\d\d)",netStatOut.lower()):
-        #print portInUse
-        if port == int(portInUse):
-            port += 1
+    assert n < PORT_BLOCK_SIZE, "node index %d outside of the reserved port block" % n
+    port = port_block_base() + n
     os.environ["node" + str(n)] = str(port)
-
-    #print "port node " + str(n) + " is " + str(port)
-    return int(port)
+    return port
 
 def rpc_port(n):
     #If port is already defined then return port
     if os.getenv("rpcnode" + str(n)):
         return int(os.getenv("rpcnode" + str(n)))
-    #If no port defined then find an available port
-    if n == 0:
-        port = 12000 + n + os.getpid()%990
-    else:
-        port = int(os.getenv("rpcnode" + str(n-1))) + 1
-    from subprocess import check_output
-    netStatOut = check_output(["netstat", "-n"])
-    for portInUse in re.findall(b"tcp.*?:(12\d\d\d)",netStatOut.lower()):
-        #print portInUse
-        if port == int(portInUse):
-            port += 1
+    assert n < PORT_BLOCK_SIZE, "node index %d outside of the reserved port block" % n
+    port = port_block_base() + PORT_RANGE + n
     os.environ["rpcnode" + str(n)] = str(port)
-
-    #print "port rpcnode " + str(n) + " is " + str(port)
-    return int(port)
+    return port
 
 def check_json_precision():
     """Make sure json library being used does not lose precision converting BTC values"""
@@ -167,31 +264,145 @@ def hex_str_to_bytes(hex_str):
 def str_to_b64str(string):
     return b64encode(string.encode('utf-8')).decode('ascii')
 
-def sync_blocks(rpc_connections, wait=1):
+# Default number of seconds sync_blocks/sync_mempools wait before giving up
+SYNC_TIMEOUT = 600
+
+# sync_* start polling after this many seconds and double the interval up to
+# their 'wait' argument
+SYNC_FIRST_POLL = 0.005
+
+# Thread pool shared by all NodeGroups
+NODEGROUP_MAX_THREADS = 32
+_rpc_executor = None
+
+class NodeGroupError(Exception):
+    """
+    Raised by NodeGroup when a call failed on one or more nodes.
+    'errors' maps the index of each failing node to its exception and
+    'results' holds the result (or exception) of every node, in node order.
+    """
+    def __init__(self, method, results, errors):
+        Exception.__init__(self)
+        self.method = method
+        self.results = results
+        self.errors = errors
+
+    def __str__(self):
+        return "%s failed on %d node(s): %s" % (self.method, len(self.errors),
+            "; ".join("node%d: %s" % (i, repr(e)) for i, e in sorted(self.errors.items())))
+
+class NodeGroup(object):
     """
-    Wait until everybody has the same block count
+    Run the same RPC against several nodes concurrently, e.g.
+
+        NodeGroup(self.nodes).generate(1)
+        counts = NodeGroup(self.nodes).getblockcount()
+
+    Each call blocks until every node answered and returns the results in
+    node order.  If any node raised, a NodeGroupError with the per-node
+    exceptions is raised once all calls have finished.
     """
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __getitem__(self, i):
+        return self.nodes[i]
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
+
+    def call(self, method, *args):
+        """Call RPC 'method' with the same args on every node"""
+        return self.map(lambda node: getattr(node, method)(*args), method)
+
+    def map(self, fn, name=None):
+        """Call fn(node) for every node concurrently, return the results in node order"""
+        global _rpc_executor
+        if len(self.nodes) <= 1:
+            futures = None
+        else:
+            if _rpc_executor is None:
+                _rpc_executor = ThreadPoolExecutor(max_workers=NODEGROUP_MAX_THREADS)
+            futures = [ _rpc_executor.submit(fn, node) for node in self.nodes ]
+        results = []
+        errors = {}
+        for i, node in enumerate(self.nodes):
+            try:
+                results.append(futures[i].result() if futures else fn(node))
+            except Exception as e:
+                results.append(e)
+                errors[i] = e
+        if errors:
+            raise NodeGroupError(name or getattr(fn, "__name__", "call"), results, errors)
+        return results
+
+def _rpc_all(rpc_connections, method, *args):
+    """Issue the same RPC to every connection concurrently, results in order"""
+    return NodeGroup(rpc_connections).call(method, *args)
+
+def _sync_wait(check, wait, timeout):
+    """
+    Call check() with exponentially growing pauses (capped at 'wait') until
+    it returns True or 'timeout' seconds have passed.  Returns whether check
+    succeeded.
+    """
+    if timeout is None:
+        timeout = SYNC_TIMEOUT
+    deadline = time.time() + timeout
+    sleep = SYNC_FIRST_POLL
     while True:
-        counts = [ x.getblockcount() for x in rpc_connections ]
-        print(counts)
-        if counts == [ counts[0] ]*len(counts):
-            break
-        time.sleep(wait)
+        if check():
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(min(sleep, wait, max(0, deadline - time.time())))
+        sleep *= 2
+
+def sync_blocks(rpc_connections, wait=1, timeout=None):
+    """
+    Wait until everybody has the same best block.
+    Polls all nodes concurrently, starting with a few milliseconds between
+    polls and backing off up to 'wait' seconds.  Raises AssertionError with
+    the heights and tips of all nodes if they don't agree within 'timeout'
+    seconds (default SYNC_TIMEOUT).
+    """
+    def tips_match():
+        tips = _rpc_all(rpc_connections, "getbestblockhash")
+        return tips == [ tips[0] ]*len(tips)
+
+    if not _sync_wait(tips_match, wait, timeout):
+        tips = _rpc_all(rpc_connections, "getbestblockhash")
+        counts = _rpc_all(rpc_connections, "getblockcount")
+        raise AssertionError("Block sync timed out:\n" + "".join(
+            "  %s: height %d tip %s\n" % (getattr(x, "url", i), c, t)
+            for i, (x, c, t) in enumerate(zip(rpc_connections, counts, tips))))
+    if os.getenv("PYTHON_DEBUG", ""):
+        print("sync_blocks: all nodes at", rpc_connections[0].getbestblockhash())
 
-def sync_mempools(rpc_connections, wait=1):
+def sync_mempools(rpc_connections, wait=1, timeout=None):
     """
     Wait until everybody has the same transactions in their memory
-    pools
+    pools.  Polls like sync_blocks; on timeout the AssertionError lists
+    every node's mempool size and how it differs from the first node's.
     """
-    while True:
-        pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        for i in range(1, len(rpc_connections)):
-            if set(rpc_connections[i].getrawmempool()) == pool:
-                num_match = num_match+1
-        if num_match == len(rpc_connections):
-            break
-        time.sleep(wait)
+    def pools_match():
+        pools = [ set(x) for x in _rpc_all(rpc_connections, "getrawmempool") ]
+        return all(pool == pools[0] for pool in pools[1:])
+
+    if not _sync_wait(pools_match, wait, timeout):
+        pools = [ set(x) for x in _rpc_all(rpc_connections, "getrawmempool") ]
+        raise AssertionError("Mempool sync timed out:\n" + "".join(
+            "  %s: %d txs, %d missing and %d extra compared to the first node\n"
+            % (getattr(x, "url", i), len(pool), len(pools[0] - pool), len(pool - pools[0]))
+            for i, (x, pool) in enumerate(zip(rpc_connections, pools))))
 
 bitcoind_processes = {}
 
@@ -244,12 +455,8 @@ def wait_for_bitcoind_start(process, url, i):
                 raise # unkown JSON RPC exception
         time.sleep(0.25)
 
-def initialize_chain(test_dir,bitcoinConfDict=None,wallets=None):
-    """
-    Create (or copy from cache) a 200-block-long chain and
-    4 wallets.
-    """
-
+def _build_cache(bitcoinConfDict=None):
+    """Build the cached 200-block chain unless it is already there"""
     if (not os.path.isdir(os.path.join("cache","node0"))
         or not os.path.isdir(os.path.join("cache","node1"))
         or not os.path.isdir(os.path.join("cache","node2"))
@@ -306,6 +513,26 @@ def initialize_chain(test_dir,bitcoinConfDict=None,wallets=None):
             os.remove(log_filename("cache", i, "peers.dat"))
             os.remove(log_filename("cache", i, "fee_estimates.dat"))
 
+def initialize_chain(test_dir,bitcoinConfDict=None,wallets=None):
+    """
+    Create (or copy from cache) a 200-block-long chain and
+    4 wallets.
+    """
+
+    # The pull-tester may run several test scripts in parallel, all sharing
+    # the same cache directory. Hold an exclusive lock while checking and
+    # (re)building it so that nobody copies a half-built cache.
+    if not os.path.isdir("cache"):
+        os.makedirs("cache", exist_ok=True)
+    with open(os.path.join("cache", ".lock"), "w") as cache_lock:
+        if fcntl:
+            fcntl.flock(cache_lock, fcntl.LOCK_EX)
+        try:
+            _build_cache(bitcoinConfDict)
+        finally:
+            if fcntl:
+                fcntl.flock(cache_lock, fcntl.LOCK_UN)
+
     for i in range(4):
         from_dir = os.path.join("cache", "node"+str(i))
         to_dir = os.path.join(test_dir,  "node"+str(i))
@@ -405,13 +632,11 @@ def stop_node(node, i):
     del bitcoind_processes[i]
 
 def stop_nodes(nodes):
-    for node in nodes:
-        node.stop()
+    NodeGroup(nodes).stop()
     del nodes[:] # Emptying array closes connections as a side effect
 
 def set_node_times(nodes, t):
-    for node in nodes:
-        node.setmocktime(t)
+    NodeGroup(nodes).setmocktime(t)
 
 def wait_bitcoinds():
     # Wait for all bitcoinds to cleanly exit
@@ -440,6 +665,16 @@ def interconnect_nodes(nodes):
         ip_port = up.hostname + ":" + str(up.port-1000)  # this is the RPC port but we want the p2p port so -1000
         frm.addnode(ip_port, "onetry")
 
+def get_new_addresses(node, count):
+    """
+    Return 'count' new addresses from the node's wallet, requested in
+    JSON-RPC batches instead of one round-trip per address.
+    """
+    with node.batch() as b:
+        for i in range(count):
+            b.getnewaddress()
+    return b.results()
+
 def find_output(node, txid, amount):
     """
     Return index to output of txid with value amount
@@ -464,7 +699,8 @@ def gather_inputs(from_node, amount_needed, confirmations_required=1):
     while total_in < amount_needed and len(utxo) > 0:
         t = utxo.pop()
         total_in += t["amount"]
-        inputs.append({ "txid" : t["txid"], "vout" : t["vout"], "address" : t["address"] } )
+        inputs.append({ "txid" : t["txid"], "vout" : t["vout"], "address" : t["address"],
+                        "scriptPubKey" : t["scriptPubKey"] } )
     if total_in < amount_needed:
         raise RuntimeError("Insufficient funds: need %d, have %d"%(amount_needed, total_in))
     return (total_in, inputs)
@@ -486,12 +722,24 @@ def make_change(from_node, amount_in, amount_out, fee):
         outputs[from_node.getnewaddress()] = change
     return outputs
 
-def send_zeropri_transaction(from_node, to_node, amount, fee):
+def wallet_prevout(node, txid, vout):
+    """
+    The listunspent style dict of output vout of node's wallet transaction
+    txid, as TxSigner.signrawtransaction takes them
+    """
+    wtx = node.gettransaction(txid)
+    out = node.decoderawtransaction(wtx["hex"])["vout"][vout]
+    address = [ d.get("address") for d in wtx["details"] if d["vout"] == vout ]
+    return { "txid" : txid, "vout" : vout, "address" : address[0] if address else None,
+             "scriptPubKey" : out["scriptPubKey"]["hex"], "amount" : out["value"] }
+
+def send_zeropri_transaction(from_node, to_node, amount, fee, signer=None):
     """
     Create&broadcast a zero-priority transaction.
     Returns (txid, hex-encoded-txdata)
     Ensures transaction is zero-priority by first creating a send-to-self,
-    then using its output
+    then using its output.  Pass a TxSigner(..., node=from_node) to sign
+    locally.
     """
 
     # Create a send-to-self with confirmed inputs:
@@ -501,7 +749,10 @@ def send_zeropri_transaction(from_node, to_node, amount, fee):
     outputs[self_address] = float(amount+fee)
 
     self_rawtx = from_node.createrawtransaction(inputs, outputs)
-    self_signresult = from_node.signrawtransaction(self_rawtx)
+    if signer is None:
+        self_signresult = from_node.signrawtransaction(self_rawtx)
+    else:
+        self_signresult = signer.signrawtransaction(self_rawtx, inputs)
     self_txid = from_node.sendrawtransaction(self_signresult["hex"], True)
 
     vout = find_output(from_node, self_txid, amount+fee)
@@ -511,7 +762,10 @@ def send_zeropri_transaction(from_node, to_node, amount, fee):
     outputs = { to_node.getnewaddress() : float(amount) }
 
     rawtx = from_node.createrawtransaction(inputs, outputs)
-    signresult = from_node.signrawtransaction(rawtx)
+    if signer is None:
+        signresult = from_node.signrawtransaction(rawtx)
+    else:
+        signresult = signer.signrawtransaction(rawtx, [ wallet_prevout(from_node, self_txid, vout) ])
     txid = from_node.sendrawtransaction(signresult["hex"], True)
 
     return (txid, signresult["hex"])
@@ -554,6 +808,8 @@ def split_transaction(node, prevouts, toAddrs, txfeePer=DEFAULT_TX_FEE_PER_BYTE,
            prevouts: a single UTXO description dictionary, or a list of them
            toAddrs: a list of strings specifying the output addresses
            "sendtx=False" if you don't want to transaction to be submitted.
+           "signer=TxSigner" to sign locally rather than with signrawtransaction
+               (the prevouts must carry their "scriptPubKey", as listunspent's do)
       Returns (transaction in hex, Vin list, Vout list)
     """
     if type(prevouts) == type({}): prevouts = [prevouts]  # If the user passes just one transaction then put a list around it 
@@ -605,7 +861,10 @@ def split_transaction(node, prevouts, toAddrs, txfeePer=DEFAULT_TX_FEE_PER_BYTE,
               try:
                   s = str(txn)
                   # print "tx len: ", len(binascii.unhexlify(s))
-                  signedtxn = node.signrawtransaction(s)
+                  if kwargs.get("signer") is not None:
+                      signedtxn = kwargs["signer"].signrawtransaction(s, prevouts)
+                  else:
+                      signedtxn = node.signrawtransaction(s)
                   txLen = len(binascii.unhexlify(signedtxn["hex"]))  # Get the actual transaction size for better tx fee estimation the next time around
               finally:
                   #print time.strftime('%X %x %Z')
@@ -628,9 +887,9 @@ def split_transaction(node, prevouts, toAddrs, txfeePer=DEFAULT_TX_FEE_PER_BYTE,
                           continue
                       else:
                           raise
-              else:
-                  for err in signedtxn["errors"]:
-                      print(err["error"])
+              else:  # signing again won't help, so don't loop forever
+                  raise RuntimeError("split_transaction: could not sign %s: %s" %
+                                     (txn, "; ".join(err["error"] for err in signedtxn["errors"])))
           else:
               return (txn,inp,outp,txid)
     finally:
@@ -762,11 +1021,15 @@ def gen_return_txouts():
         txouts = txouts + script_pubkey
     return txouts
 
-def create_tx(node, coinbase, to_address, amount):
+def create_tx(node, coinbase, to_address, amount, signer=None):
+    """Spend output 0 of coinbase; pass a TxSigner(..., node=node) to sign locally"""
     inputs = [{ "txid" : coinbase, "vout" : 0}]
     outputs = { to_address : amount }
     rawtx = node.createrawtransaction(inputs, outputs)
-    signresult = node.signrawtransaction(rawtx)
+    if signer is None:
+        signresult = node.signrawtransaction(rawtx)
+    else:
+        signresult = signer.signrawtransaction(rawtx, [ wallet_prevout(node, coinbase, 0) ])
     assert_equal(signresult["complete"], True)
     return signresult["hex"]
 
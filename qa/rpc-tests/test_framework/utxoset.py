@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# utxoset.py - client side view of a node's spendable wallet coins
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# UtxoSet is seeded once from listunspent and then kept up to date from the
+# transactions the test sends and the blocks it mines, so loops that create
+# or consolidate thousands of coins don't have to fetch and sort the whole
+# wallet on every iteration.
+#
+
+from .mininode import *
+from .authproxy import JSONRPCException
+from .util import bytes_to_hex_str
+import heapq
+
+# Coinbase outputs show up in listunspent once their block is this deep
+COINBASE_MATURITY = 101
+
+
+class UtxoSet(object):
+    """
+    The coins listunspent() would return (confirmed, mature, unspent), as
+    listunspent style dicts, with the largest or smallest one available in
+    O(log n):
+
+        utxos = UtxoSet(node)
+        (txn, inp, outp, txid) = split_transaction(node, utxos.largest(), addrs)
+        utxos.add_transaction(txid)
+        utxos.add_blocks(node.generate(1))
+
+    Only the node's own transactions and blocks reach it through
+    add_transaction()/add_blocks(); call refresh() after anything else
+    (a reorg, coins sent from another wallet) touched the wallet.  Like
+    the wallet's own transaction details it does not see change outputs
+    the wallet added itself (sendtoaddress & co), only explicit outputs
+    as createrawtransaction builds them.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.refresh()
+
+    def refresh(self):
+        """(Re)load everything from listunspent"""
+        self.height = self.node.getblockcount()
+        self.coins = {}     # (txid, vout) -> listunspent style dict
+        self.pending = {}   # txid -> coins of ours waiting for a block
+        self.immature = []  # heap of (height, txid) of our coinbases
+        self.coinbases = {} # txid -> coins of an immature coinbase
+        self.small = []     # heap of (amount, txid, vout)
+        self.large = []     # heap of (-amount, txid, vout)
+        for utxo in self.node.listunspent():
+            self.add(utxo)
+
+    def add(self, utxo):
+        key = (utxo["txid"], utxo["vout"])
+        self.coins[key] = utxo
+        if len(self.small) > 2 * len(self.coins) + 64:
+            # mostly stale entries by now, rebuild both heaps
+            self.small = [ (u["amount"],) + k for (k, u) in self.coins.items() ]
+            self.large = [ (-u["amount"],) + k for (k, u) in self.coins.items() ]
+            heapq.heapify(self.small)
+            heapq.heapify(self.large)
+            return
+        heapq.heappush(self.small, (utxo["amount"],) + key)
+        heapq.heappush(self.large, (-utxo["amount"],) + key)
+
+    # Spent coins are only dropped from self.coins; the heaps skip such
+    # stale entries lazily.
+    def discard(self, txid, vout):
+        self.coins.pop((txid, vout), None)
+        if txid in self.pending:
+            self.pending[txid] = [ utxo for utxo in self.pending[txid] if utxo["vout"] != vout ]
+
+    def __len__(self):
+        return len(self.coins)
+
+    def __iter__(self):
+        return iter(list(self.coins.values()))
+
+    def __contains__(self, utxo):
+        return (utxo["txid"], utxo["vout"]) in self.coins
+
+    def total(self):
+        return sum(utxo["amount"] for utxo in self.coins.values())
+
+    def pop_smallest(self):
+        """Remove and return the smallest coin"""
+        return self._pop(self.small)
+
+    def pop_largest(self):
+        """Remove and return the largest coin"""
+        return self._pop(self.large)
+
+    def smallest(self, n=None):
+        """The smallest coin, or a list of the n smallest, without removing them"""
+        return self._peek(self.small, n)
+
+    def largest(self, n=None):
+        """The largest coin, or a list of the n largest, without removing them"""
+        return self._peek(self.large, n)
+
+    def _pop(self, heap):
+        while heap:
+            (amount, txid, vout) = heapq.heappop(heap)
+            utxo = self.coins.pop((txid, vout), None)
+            if utxo is not None:
+                return utxo
+        raise IndexError("no coins left")
+
+    def _peek(self, heap, n):
+        taken = []
+        try:
+            for i in range(1 if n is None else n):
+                taken.append(self._pop(heap))
+        except IndexError:
+            if n is None:
+                raise
+        for utxo in taken:
+            self.add(utxo)
+        return taken[0] if n is None else taken
+
+    def add_transaction(self, txid, height=None):
+        """
+        Account for a wallet transaction the test just sent: its inputs are
+        spent and its outputs to us become available once it is mined.
+        height is that of the block holding it, if known.
+        """
+        wtx = self.node.gettransaction(txid)
+        tx = FromHex(CTransaction(), wtx["hex"])
+        for txin in tx.vin:
+            self.discard("%064x" % txin.prevout.hash, txin.prevout.n)
+        coins = []
+        for detail in wtx["details"]:
+            if detail["category"] in ("receive", "generate", "immature"):
+                coins.append({
+                    "txid": txid,
+                    "vout": detail["vout"],
+                    "address": detail.get("address"),
+                    "account": detail.get("account", ""),
+                    "scriptPubKey": bytes_to_hex_str(tx.vout[detail["vout"]].scriptPubKey),
+                    "amount": detail["amount"],
+                    "confirmations": wtx["confirmations"],
+                    "spendable": True
+                })
+        if wtx.get("generated", False):
+            if height is None:
+                height = self.node.getblockcount() - wtx["confirmations"] + 1
+            if height + COINBASE_MATURITY <= self.height + 1:
+                [ self.add(utxo) for utxo in coins ]
+            elif coins:
+                self.coinbases[txid] = coins
+                heapq.heappush(self.immature, (height, txid))
+        elif wtx["confirmations"] > 0:
+            [ self.add(utxo) for utxo in coins ]
+        elif coins:
+            self.pending[txid] = coins
+
+    def add_blocks(self, blockhashes):
+        """Account for blocks just mined on top of the tip, in order"""
+        for blockhash in blockhashes:
+            block = self.node.getblock(blockhash)
+            self.height = block["height"]
+            for txid in block["tx"]:
+                if txid in self.pending:
+                    [ self.add(utxo) for utxo in self.pending.pop(txid) ]
+                elif txid == block["tx"][0]:
+                    try:
+                        self.add_transaction(txid, block["height"])
+                    except JSONRPCException:  # not our coinbase
+                        pass
+            while self.immature and self.immature[0][0] + COINBASE_MATURITY <= self.height + 1:
+                (height, txid) = heapq.heappop(self.immature)
+                [ self.add(utxo) for utxo in self.coinbases.pop(txid) ]
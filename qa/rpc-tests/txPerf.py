@@ -17,6 +17,8 @@ logging.basicConfig(format='%(asctime)s.%(levelname)s: %(message)s', level=loggi
 
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
+from test_framework.utxoset import UtxoSet
+from test_framework.signer import TxSigner, node_forkid
 
 
 # Create one-input, one-output, no-fee transaction:
@@ -92,21 +94,22 @@ class TransactionPerformanceTest(BitcoinTestFramework):
         print("tx len, # inputs, # outputs, time")
         print ("fieldNames = ['tx len', '# inputs', '# outputs', 'time']",file=fil)
         print ("data = [",file=fil)
+        utxos = UtxoSet(node)
+        signer = TxSigner(node_forkid(node), node=node)
+        signer.import_keys(node, set(outputs) | set(u["address"] for u in utxos))
         for i in range(0,inputCount,skip):
           for j in range(0,len(outputs),skip):
             print("ITER: ", i, " x ", j)
-            wallet = node.listunspent()
-            wallet.sort(key=lambda x: x["amount"],reverse=True)
-            while len(wallet) < i:  # Make a bunch more inputs
-              (txn,inp,outp,txid) = split_transaction(node, [wallet[0]], outputs, txfee=DEFAULT_TX_FEE_PER_BYTE*10)
+            while len(utxos) < i:  # Make a bunch more inputs
+              (txn,inp,outp,txid) = split_transaction(node, [utxos.largest()], outputs, txfee=DEFAULT_TX_FEE_PER_BYTE*10, signer=signer)
+              utxos.add_transaction(txid)
               self.sync_all()
-              wallet = node.listunspent()
-              wallet.sort(key=lambda x: x["amount"],reverse=True)
 
             try:
               if i==0: i=1
               if j==0: j=1
-              (txn,inp,outp,txid) = split_transaction(node, wallet[0:i], outputs[0:j], txfee=DEFAULT_TX_FEE_PER_BYTE*10, sendtx=True)
+              (txn,inp,outp,txid) = split_transaction(node, utxos.largest(i), outputs[0:j], txfee=DEFAULT_TX_FEE_PER_BYTE*10, sendtx=True, signer=signer)
+              utxos.add_transaction(txid)
             except e:
               logging.info("split error: %s" % str(e))
               print("[ 'sign',",0,",",i,",",j,",","'split error:", str(e),"'],",file=fil)
@@ -115,8 +118,9 @@ class TransactionPerformanceTest(BitcoinTestFramework):
 
             time.sleep(4) # give the transaction time to propagate so we generate tx validation data separately from block validation data
             startTime = time.time()
-            node.generate(1)
+            blocks = node.generate(1)
             elapsedTime = time.time() - startTime
+            utxos.add_blocks(blocks)
             logging.info("generate time: %f" % elapsedTime)
             txLen = len(binascii.unhexlify(txn))  # Get the actual transaction size for better tx fee estimation the next time around
             print("[ 'gen',",txLen,",",len(inp),",",len(outp),",",elapsedTime,"],",file=fil)
@@ -139,7 +143,7 @@ class TransactionPerformanceTest(BitcoinTestFramework):
         start = time.time()
         print("generating addresses")
         if 1:
-          addrs = [ node.getnewaddress() for _ in range(20000)]
+          addrs = get_new_addresses(node, 20000)
           f = open("addrs.txt","w")
           f.write(str(addrs))
           f.close()
@@ -191,7 +195,7 @@ class TransactionPerformanceTest(BitcoinTestFramework):
     
         print("Generating new addresses... will take awhile")
         start = time.time()
-        addrs = [ self.nodes[0].getnewaddress() for _ in range(TEST_SIZE+1)]
+        addrs = get_new_addresses(self.nodes[0], TEST_SIZE+1)
         print("['Benchmark', 'generate 2001 addresses', %f]" % (time.time()-start))
 
         wallet = self.nodes[0].listunspent()